@@ -0,0 +1,365 @@
+import asyncio
+import functools
+import hmac
+import logging
+import math
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+import aiohttp
+from aiohttp import web
+from bs4 import BeautifulSoup
+from werkzeug.test import EnvironBuilder, run_wsgi_app
+import main_server
+from main_server import (server_key, cache_get, cache_lookup, cache_ttl, encode_json, encode_search_response,
+                         trending_response, trending_response_ttl, store_search_result, acquire_flight, finish_flight,
+                         poll_flight, flight_pending, flight_poll_interval, increment_counter, is_inappropriate,
+                         appropriate_only, normalize_query, log_query, partial_query_recommendation, observe, timed,
+                         admit_request, page_key, parse_search_pagination, take_from_page, encode_search_page,
+                         search_max_upstream_pages, search_request_pages, parse_image_proxy, proxied_image_url,
+                         record_first_request, log_full_policy, sign_image_url, parse_image_width, get_image,
+                         image_path, image_max_age, forwarded_client)
+
+# Upstream settings: keep-alive pool size and deadline for one PeakPx call, in seconds
+upstream_max_connections = 256
+upstream_timeout = 10
+# Threads for state database calls and other blocking work, which can wait up
+# to the SQLite busy timeout while another process holds the write lock
+blocking_threads = 32
+# The event loop never waits for room in a full query log buffer
+loop_log_policy = 'drop_newest' if log_full_policy == 'block' else log_full_policy
+
+# Flight lease owner of this worker's event loop; the flight calls run on pool
+# threads, so the thread-based owner main_server uses would differ between them
+def loop_flight_owner():
+    return f'{os.getpid()}:loop'
+
+# Run a blocking call on the worker's thread pool instead of the event loop
+async def in_thread(app, function, *args):
+    return await asyncio.get_running_loop().run_in_executor(app['blocking'], functools.partial(function, *args))
+
+# Same encoding as Flask's jsonify, so both serving modes return identical bodies
+def json_response(data, status=200):
+    return web.Response(text=encode_json(data) + '\n', status=status, content_type='application/json')
+
+def etag_matches(if_none_match, etag):
+    if not if_none_match:
+        return False
+    tags = [tag.strip() for tag in if_none_match.split(',')]
+    return '*' in tags or any(tag.removeprefix('W/').strip('"') == etag for tag in tags)
+
+# Response for an encoded JSON body, or 304 when the client already has it
+def json_bytes_response(request, body, etag, max_age):
+    headers = {'ETag': f'"{etag}"', 'Cache-Control': f'public, max-age={max(int(max_age), 0)}'}
+    if etag_matches(request.headers.get('If-None-Match'), etag):
+        return web.Response(status=304, headers=headers)
+    return web.Response(body=body, content_type='application/json', headers=headers)
+
+# Extract image URLs the same way PeakPxApi does
+def parse_wallpapers(content):
+    all_links = []
+    for link in BeautifulSoup(content, 'html.parser').find_all('img'):
+        try:
+            img = str(link.get('data-srcset')).split()[0]
+            if img.endswith('jpg') or img.endswith('png'):
+                all_links.append(dict(url=img))
+        except Exception:
+            continue
+    return all_links
+
+# PeakPx search over a shared, pooled aiohttp session
+class AsyncPeakPx:
+    def __init__(self, session, url='https://www.peakpx.com'):
+        self.session = session
+        self.url = url
+
+    async def search_wallpapers(self, query, page=1):
+        async with self.session.get(f'{self.url}/en/search', params={'q': query, 'page': page}) as response:
+            content = await response.read()
+        # Parsing is CPU work, keep it off the event loop
+        return await asyncio.get_running_loop().run_in_executor(None, parse_wallpapers, content)
+
+async def upstream_ctx(app):
+    connector = aiohttp.TCPConnector(limit=upstream_max_connections, keepalive_timeout=60)
+    timeout = aiohttp.ClientTimeout(total=upstream_timeout)
+    async with aiohttp.ClientSession(connector=connector, timeout=timeout) as session:
+        app['px'] = AsyncPeakPx(session, main_server.px.url)
+        app['flights'] = {}
+        app['blocking'] = ThreadPoolExecutor(max_workers=blocking_threads)
+        try:
+            yield
+        finally:
+            app['blocking'].shutdown(wait=False)
+
+async def fetch_from_upstream(app, query, page=1):
+    increment_counter('search_upstream_calls')
+    status = 'error'
+    try:
+        with timed('peakpx_request_duration_seconds'):
+            wallpapers = await app['px'].search_wallpapers(query, page)
+        image_urls = [wallpaper['url'] for wallpaper in wallpapers]
+        status = await in_thread(app, store_search_result, page_key(query, page), image_urls)
+        return image_urls, bool(image_urls)
+    except Exception as e:
+        increment_counter('peakpx_errors')
+        logging.error(f"Error searching wallpapers: {e!r}")
+        return [], False
+    finally:
+        await in_thread(app, finish_flight, page_key(query, page), status, loop_flight_owner())
+
+# Same single-flight protocol as main_server.fetch_across_workers, without blocking the loop
+async def fetch_across_workers(app, query, page=1):
+    key = page_key(query, page)
+    while True:
+        if await in_thread(app, acquire_flight, key, loop_flight_owner()):
+            return await fetch_from_upstream(app, query, page)
+        result = flight_pending
+        while result is flight_pending:
+            await asyncio.sleep(flight_poll_interval)
+            result = await in_thread(app, poll_flight, key)
+        if result is not None:
+            increment_counter('search_coalesced_remote')
+            return result
+
+# One fetch task per query and page in this worker; concurrent callers await the same task
+def fetch_task(app, query, page=1):
+    flights = app['flights']
+    key = page_key(query, page)
+    task = flights.get(key)
+    if task is None:
+        task = flights[key] = asyncio.ensure_future(fetch_across_workers(app, query, page))
+        task.add_done_callback(lambda _: flights.pop(key, None))
+    else:
+        increment_counter('search_coalesced_local')
+    return task
+
+async def search_wallpapers(app, query, page=1):
+    with timed('function_duration_seconds', function='search_wallpapers'):
+        key = page_key(query, page)
+        try:
+            entry = await in_thread(app, cache_get, key)
+        except Exception as e:
+            logging.error(f"Error reading search cache: {e}")
+            entry = None
+        if entry is not None:
+            image_urls, age = entry
+            if age >= cache_ttl and key not in app['flights']:
+                fetch_task(app, query, page)
+            return image_urls, True
+        return await asyncio.shield(fetch_task(app, query, page))
+
+# Same walk over upstream pages as main_server.search_wallpapers_page
+async def search_wallpapers_page(app, query, page, index, skip, limit):
+    images = []
+    for _ in range(search_request_pages):
+        if len(images) >= limit:
+            break
+        if page > search_max_upstream_pages:
+            return images, None
+        image_urls, success = await search_wallpapers(app, query, page)
+        if not success:
+            return images, None
+        taken, page, index, skip = take_from_page(image_urls, page, index, skip, limit - len(images))
+        images.extend(taken)
+    return images, f'{page}:{index + skip}'
+
+async def search_wallpapers_route(request):
+    if request.query.get('key') != server_key:
+        return json_response({'error': 'Invalid client key'}, 401)
+
+    query = normalize_query(request.query.get('query') or '')
+    if not query:
+        return json_response({'error': 'Query parameter is required'}, 400)
+
+    # Check if the query is inappropriate
+    if is_inappropriate(query):
+        return json_response([{'Image': 'https://i.pinimg.com/736x/95/55/07-9555074fb5a23ba2f2513597a95827a1.jpg'}], 400)
+
+    try:
+        pagination = parse_search_pagination(request.query)
+        proxy_width = parse_image_proxy(request.query)
+    except ValueError as e:
+        return json_response({'error': str(e)}, 400)
+    base_url = f'{request.scheme}://{request.host}/'
+    client_ip = forwarded_client(request.remote, request.headers.get('X-Forwarded-For')) or request.remote
+
+    if pagination is not None:
+        images, next_cursor = await search_wallpapers_page(request.app, query, *pagination)
+        # Only a search from the start counts as a query, not fetching its later pages
+        from_start = pagination[:3] == (1, 0, 0)
+        if from_start:
+            log_query(client_ip, query, bool(images), loop_log_policy)
+        if not images and from_start:
+            return json_response([{'recommend': 'No wallpapers found for the given query'}], 404)
+        if proxy_width is not None:
+            images = [proxied_image_url(base_url, url, proxy_width) for url in images]
+        body, etag = encode_search_page(images, next_cursor)
+        return json_bytes_response(request, body, etag, cache_ttl)
+
+    try:
+        # The pre-encoded body holds the upstream URLs, proxied ones are encoded per request
+        cached = await in_thread(request.app, cache_lookup, query) if proxy_width is None else None
+    except Exception as e:
+        logging.error(f"Error reading search cache: {e}")
+        cached = None
+    if proxy_width is None:
+        increment_counter('search_cache_misses' if cached is None else 'search_cache_hits')
+    if cached is not None:
+        log_query(client_ip, query, True, loop_log_policy)
+        _, body, etag, fetched_at = cached
+        age = time.time() - fetched_at
+        if age >= cache_ttl and query not in request.app['flights']:
+            fetch_task(request.app, query)
+        return json_bytes_response(request, body, etag, cache_ttl - age)
+
+    image_urls, success = await search_wallpapers(request.app, query)
+    log_query(client_ip, query, success, loop_log_policy)
+
+    if success:
+        if proxy_width is not None:
+            image_urls = [proxied_image_url(base_url, url, proxy_width) for url in image_urls]
+        body, etag = encode_search_response(image_urls)
+        return json_bytes_response(request, body, etag, cache_ttl)
+    else:
+        return json_response([{'recommend': 'No wallpapers found for the given query'}], 404)
+
+async def get_recommendations(request):
+    if request.query.get('key') != server_key:
+        return json_response({'error': 'Invalid client key'}, 401)
+
+    partial_query = request.query.get('q')
+    if not partial_query:
+        return json_response({'error': 'Partial query parameter (q) is required'}, 400)
+
+    if is_inappropriate(partial_query):
+        return json_response([{'recommend': 'Inappropriate query'}], 400)
+
+    # May sync the suggestion index from the state database or load the models
+    recommendations = await in_thread(request.app, partial_query_recommendation, partial_query)
+    return json_response([{'recommend': recommendation} for recommendation in appropriate_only(recommendations)])
+
+async def get_trending(request):
+    if request.query.get('key') != server_key:
+        return json_response({'error': 'Invalid client key'}, 401)
+
+    try:
+        body, etag = await in_thread(request.app, trending_response, request.query.get('window', 'all'))
+    except ValueError as e:
+        return json_response({'error': str(e)}, 400)
+    return json_bytes_response(request, body, etag, trending_response_ttl)
+
+# Image files are sent from disk by the loop; FileResponse handles Range and its
+# own validators, so If-None-Match is also checked against the content digest
+# the Flask app uses as ETag
+async def proxy_image(request):
+    source = request.query.get('url') or ''
+    if not source or not hmac.compare_digest(request.query.get('sig') or '', sign_image_url(source)):
+        return json_response({'error': 'Invalid image signature'}, 403)
+
+    try:
+        width = parse_image_width(request.query.get('width'))
+    except ValueError as e:
+        return json_response({'error': str(e)}, 400)
+
+    try:
+        digest, content_type = await in_thread(request.app, get_image, source, width)
+    except Exception as e:
+        logging.error(f"Error fetching image {source}: {e}")
+        return json_response({'error': 'Image not available'}, 502)
+
+    headers = {'Cache-Control': f'public, max-age={image_max_age}, immutable'}
+    if etag_matches(request.headers.get('If-None-Match'), digest):
+        return web.Response(status=304, headers={**headers, 'ETag': f'"{digest}"'})
+    return web.FileResponse(image_path(digest), headers={**headers, 'Content-Type': content_type})
+
+# Drain a WSGI response in one executor thread, since Flask's context vars must be
+# reset on the thread that set them; chunks are handed to the loop as they come
+def drain_wsgi_app(loop, environ, started, chunks):
+    try:
+        app_iter, status, headers = run_wsgi_app(main_server.app, environ)
+    except BaseException as e:
+        loop.call_soon_threadsafe(started.set_exception, e)
+        return
+    loop.call_soon_threadsafe(started.set_result, (status, headers))
+    try:
+        for chunk in app_iter:
+            asyncio.run_coroutine_threadsafe(chunks.put(chunk), loop).result()
+    finally:
+        if hasattr(app_iter, 'close'):
+            app_iter.close()
+        asyncio.run_coroutine_threadsafe(chunks.put(None), loop).result()
+
+# Every other route is served by the Flask app on the default executor
+async def wsgi_fallback(request):
+    environ = EnvironBuilder(path=request.path, method=request.method, query_string=request.query_string,
+                             headers=list(request.headers.items()), data=await request.read(),
+                             environ_base={'REMOTE_ADDR': request.remote}).get_environ()
+    loop = asyncio.get_running_loop()
+    started, chunks = loop.create_future(), asyncio.Queue(maxsize=8)
+    drained = loop.run_in_executor(None, drain_wsgi_app, loop, environ, started, chunks)
+    status, headers = await started
+    response = web.StreamResponse(status=int(status.split()[0]), headers=headers.to_wsgi_list())
+    await response.prepare(request)
+    chunk = b''
+    try:
+        while (chunk := await chunks.get()) is not None:
+            await response.write(chunk)
+    finally:
+        # Keep draining after a client disconnect so the producer thread can finish
+        while chunk is not None:
+            chunk = await chunks.get()
+        await drained
+    await response.write_eof()
+    return response
+
+# Latency of every request, by route and status; the Flask app times the routes it serves itself
+@web.middleware
+async def metrics_middleware(request, handler):
+    if request.match_info.handler is wsgi_fallback:
+        return await handler(request)
+    record_first_request()
+    started = time.perf_counter()
+    status = 500
+    try:
+        response = await handler(request)
+        status = response.status
+        return response
+    except web.HTTPException as e:
+        status = e.status
+        raise
+    finally:
+        observe('http_request_duration_seconds', time.perf_counter() - started, method=request.method,
+                route=request.match_info.route.resource.canonical, status=status)
+
+# Same admission control as the Flask app, which applies it to the routes it serves itself
+@web.middleware
+async def rate_limit_middleware(request, handler):
+    if request.match_info.handler is not wsgi_fallback:
+        wait = admit_request(request.match_info.route.resource.canonical,
+                             forwarded_client(request.remote, request.headers.get('X-Forwarded-For')), request.query.get('key'))
+        if wait:
+            response = json_response({'error': 'Too many requests'}, 429)
+            response.headers['Retry-After'] = str(math.ceil(wait))
+            return response
+    return await handler(request)
+
+@web.middleware
+async def cors_middleware(request, handler):
+    response = await handler(request)
+    response.headers.setdefault('Access-Control-Allow-Origin', '*')
+    return response
+
+def create_app():
+    app = web.Application(middlewares=[cors_middleware, metrics_middleware, rate_limit_middleware])
+    app.cleanup_ctx.append(upstream_ctx)
+    app.router.add_get('/search_wallpapers', search_wallpapers_route)
+    app.router.add_get('/recommendations', get_recommendations)
+    app.router.add_get('/trending', get_trending)
+    app.router.add_get('/image', proxy_image)
+    app.router.add_route('*', '/{tail:.*}', wsgi_fallback)
+    return app
+
+app = create_app()
+
+if __name__ == "__main__":
+    web.run_app(app, port=5000)
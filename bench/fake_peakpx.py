@@ -0,0 +1,72 @@
+import argparse
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+# Local stand-in for peakpx.com: /en/search answers with result_size images in
+# the same HTML shape PeakPxApi parses, after latency seconds (+/- 20% jitter),
+# and fails with a 503 for error_rate of the requests.
+class FakePeakPx(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, latency=0.2, error_rate=0.0, result_size=24, seed=None):
+        super().__init__(address, FakePeakPxHandler)
+        self.latency = latency
+        self.error_rate = error_rate
+        self.result_size = result_size
+        self.random = random.Random(seed)
+        self.requests = 0
+        self.lock = threading.Lock()
+
+    @property
+    def url(self):
+        return f'http://{self.server_address[0]}:{self.server_address[1]}'
+
+    def start(self):
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+class FakePeakPxHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        server = self.server
+        url = urlparse(self.path)
+        params = parse_qs(url.query)
+        with server.lock:
+            server.requests += 1
+            delay = server.latency * server.random.uniform(0.8, 1.2)
+            failed = server.random.random() < server.error_rate
+        time.sleep(delay)
+        if url.path != '/en/search' or failed:
+            self.send_response(503 if failed else 404)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        query = params.get('q', [''])[0].replace(' ', '-')
+        page = params.get('page', ['1'])[0]
+        images = ''.join(f'<img data-srcset="https://img.peakpx.local/{query}/{page}/{i}.jpg 1x">'
+                         for i in range(server.result_size))
+        body = f'<html><body>{images}</body></html>'.encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/html; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run a local PeakPx stand-in")
+    parser.add_argument('--port', type=int, default=8099)
+    parser.add_argument('--latency', type=float, default=0.2, help="seconds per search")
+    parser.add_argument('--error-rate', type=float, default=0.0, help="fraction of searches answered with 503")
+    parser.add_argument('--result-size', type=int, default=24, help="images per result page")
+    args = parser.parse_args()
+
+    server = FakePeakPx(('127.0.0.1', args.port), args.latency, args.error_rate, args.result_size)
+    print(f"Fake PeakPx listening on {server.url}")
+    server.serve_forever()
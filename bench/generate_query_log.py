@@ -0,0 +1,54 @@
+import argparse
+import csv
+import random
+import time
+import uuid
+
+ADJECTIVES = ['red', 'blue', 'dark', 'neon', 'cute', 'minimal', 'retro', 'cyberpunk', 'aesthetic', 'pastel',
+              'black', 'white', 'golden', 'abstract', 'vintage', 'anime', 'space', 'winter', 'summer', 'night']
+NOUNS = ['cat', 'dog', 'car', 'bike', 'mountain', 'ocean', 'forest', 'city', 'sunset', 'galaxy', 'flower',
+         'tiger', 'dragon', 'robot', 'castle', 'beach', 'river', 'skyline', 'wolf', 'planet', 'naruto', 'goku']
+
+# Distinct queries: single nouns, adjective + noun pairs, then numbered variants as needed
+def vocabulary(size):
+    queries = NOUNS + [f'{adjective} {noun}' for adjective in ADJECTIVES for noun in NOUNS]
+    i = 2
+    while len(queries) < size:
+        queries.extend(f'{query} {i}' for query in queries[:size - len(queries)])
+        i += 1
+    return queries[:size]
+
+# Write rows in the ip_query_log.csv format with Zipf-distributed queries spread over the last days
+def generate(filename, rows, distinct, clients, days, skew=1.1, seed=0, chunk=100000):
+    rng = random.Random(seed)
+    queries = vocabulary(distinct)
+    weights = [1 / (rank ** skew) for rank in range(1, len(queries) + 1)]
+    client_list = [(str(uuid.UUID(int=rng.getrandbits(128), version=4)), f'10.{i // 65536 % 256}.{i // 256 % 256}.{i % 256}')
+                   for i in range(clients)]
+    start = time.time() - days * 86400
+    step = days * 86400 / max(rows, 1)
+    with open(filename, 'w', newline='') as file:
+        writer = csv.writer(file)
+        writer.writerow(["ID", "IP Address", "Query", "Timestamp", "Response Status"])
+        written = 0
+        while written < rows:
+            n = min(chunk, rows - written)
+            picked = rng.choices(queries, weights, k=n)
+            picked_clients = rng.choices(client_list, k=n)
+            writer.writerows(
+                [client_id, ip, query, time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(start + (written + i) * step)),
+                 rng.random() < 0.97]
+                for i, (query, (client_id, ip)) in enumerate(zip(picked, picked_clients)))
+            written += n
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Generate a synthetic query log")
+    parser.add_argument('output', help="CSV file to write")
+    parser.add_argument('--rows', type=int, default=10000, help="number of rows, e.g. 10000 to 10000000")
+    parser.add_argument('--distinct', type=int, help="distinct queries (default rows / 20, at least 100)")
+    parser.add_argument('--clients', type=int, default=1000)
+    parser.add_argument('--days', type=int, default=30)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    generate(args.output, args.rows, args.distinct or max(args.rows // 20, 100), args.clients, args.days, seed=args.seed)
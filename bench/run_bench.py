@@ -0,0 +1,219 @@
+import argparse
+import http.client
+import json
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from urllib.parse import urlencode
+import psutil
+from fake_peakpx import FakePeakPx
+from generate_query_log import generate, vocabulary
+
+# Hermetic load test: a synthetic query log is imported into a scratch working
+# directory, gunicorn serves the app from there against the local PeakPx
+# stand-in, and every scenario is driven for a fixed duration by keep-alive
+# client threads. Results can be saved as the baseline and later runs are
+# compared against it.
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BASELINE_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'baseline.json')
+SERVER_KEY = 'wallartify2024new'
+
+def scenarios(queries):
+    hot = queries[:50]
+    return {
+        'search_wallpapers': lambda rng: ('/search_wallpapers', {'query': rng.choice(hot if rng.random() < 0.9 else queries)}),
+        'recommendations': lambda rng: ('/recommendations', {'q': rng.choice(queries)[:rng.randint(1, 4)]}),
+        'trending': lambda rng: ('/trending', {'window': rng.choice(['all', 'hour', 'day', 'week'])}),
+        'view_logs': lambda rng: ('/view_logs', {'limit': 100, 'query': rng.choice(hot)}),
+        'monitoring': lambda rng: ('/monitoring', {}),
+        'metrics': lambda rng: ('/metrics', {}),
+    }
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return None
+    return sorted_values[min(int(fraction * len(sorted_values)), len(sorted_values) - 1)]
+
+# Drive one scenario with `concurrency` client threads for `duration` seconds
+def run_scenario(port, make_request, concurrency, duration, master_pid):
+    latencies, errors = [], [0]
+    lock = threading.Lock()
+    deadline = time.monotonic() + duration
+
+    def client(seed):
+        rng = random.Random(seed)
+        conn = http.client.HTTPConnection('127.0.0.1', port, timeout=30)
+        local_latencies, local_errors = [], 0
+        while time.monotonic() < deadline:
+            path, params = make_request(rng)
+            params['key'] = SERVER_KEY
+            started = time.perf_counter()
+            try:
+                conn.request('GET', f'{path}?{urlencode(params)}')
+                response = conn.getresponse()
+                response.read()
+                if response.status >= 500:
+                    local_errors += 1
+            except (OSError, http.client.HTTPException):
+                local_errors += 1
+                conn.close()
+                conn = http.client.HTTPConnection('127.0.0.1', port, timeout=30)
+            local_latencies.append(time.perf_counter() - started)
+        conn.close()
+        with lock:
+            latencies.extend(local_latencies)
+            errors[0] += local_errors
+
+    rss = {}
+    sampling = threading.Event()
+
+    def sample_rss():
+        while not sampling.wait(0.5):
+            for worker in psutil.Process(master_pid).children():
+                try:
+                    rss[worker.pid] = max(rss.get(worker.pid, 0), worker.memory_info().rss)
+                except psutil.NoSuchProcess:
+                    pass
+
+    sampler = threading.Thread(target=sample_rss, daemon=True)
+    sampler.start()
+    started = time.monotonic()
+    clients = [threading.Thread(target=client, args=(i,)) for i in range(concurrency)]
+    for thread in clients:
+        thread.start()
+    for thread in clients:
+        thread.join()
+    elapsed = time.monotonic() - started
+    sampling.set()
+    sampler.join()
+
+    latencies.sort()
+    return {
+        'requests': len(latencies),
+        'errors': errors[0],
+        'throughput': round(len(latencies) / elapsed, 1),
+        'p50_ms': round(percentile(latencies, 0.50) * 1000, 2) if latencies else None,
+        'p95_ms': round(percentile(latencies, 0.95) * 1000, 2) if latencies else None,
+        'p99_ms': round(percentile(latencies, 0.99) * 1000, 2) if latencies else None,
+        'max_worker_rss_mb': round(max(rss.values()) / 2 ** 20, 1) if rss else None,
+        'worker_rss_mb': sorted(round(value / 2 ** 20, 1) for value in rss.values()),
+    }
+
+def wait_until_ready(port, timeout=60):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            conn = http.client.HTTPConnection('127.0.0.1', port, timeout=2)
+            conn.request('GET', f'/trending?key={SERVER_KEY}')
+            conn.getresponse().read()
+            return
+        except OSError:
+            time.sleep(0.2)
+    raise RuntimeError(f"Server did not start listening on port {port} within {timeout}s")
+
+# Scenario metrics that got worse than the baseline by more than the tolerance
+def compare(results, baseline, tolerance):
+    regressions = []
+    for name, result in results.items():
+        base = baseline.get(name)
+        if not base:
+            continue
+        if base['throughput'] and result['throughput'] < base['throughput'] * (1 - tolerance):
+            regressions.append(f"{name}: throughput {result['throughput']} < baseline {base['throughput']}")
+        for metric in ('p50_ms', 'p95_ms', 'p99_ms', 'max_worker_rss_mb'):
+            if base.get(metric) and result.get(metric) and result[metric] > base[metric] * (1 + tolerance):
+                regressions.append(f"{name}: {metric} {result[metric]} > baseline {base[metric]}")
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description="Run the hermetic load test against a local PeakPx stand-in")
+    parser.add_argument('--rows', type=int, default=10000, help="synthetic query log rows (10000 to 10000000)")
+    parser.add_argument('--mode', choices=['sync', 'async'], default='sync', help="serving mode to benchmark")
+    parser.add_argument('--startup-mode', choices=['preload', 'lazy'], default='preload',
+                        help="import the app once in the gunicorn master, or in every worker")
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--duration', type=float, default=10, help="seconds per scenario")
+    parser.add_argument('--concurrency', type=int, default=16, help="client threads per scenario")
+    parser.add_argument('--scenario', action='append', help="run only these scenarios (repeatable)")
+    parser.add_argument('--latency', type=float, default=0.2, help="fake PeakPx seconds per search")
+    parser.add_argument('--error-rate', type=float, default=0.0, help="fake PeakPx fraction of failed searches")
+    parser.add_argument('--result-size', type=int, default=24, help="fake PeakPx images per result")
+    parser.add_argument('--port', type=int, default=5055)
+    parser.add_argument('--output', help="write the results as JSON to this file")
+    parser.add_argument('--baseline', default=BASELINE_FILE, help="baseline results to compare against")
+    parser.add_argument('--save-baseline', action='store_true', help="store these results as the baseline")
+    parser.add_argument('--tolerance', type=float, default=0.15, help="allowed relative regression")
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix='wallartify-bench-')
+    upstream = FakePeakPx(('127.0.0.1', 0), args.latency, args.error_rate, args.result_size, seed=0).start()
+    server = None
+    try:
+        distinct = max(args.rows // 20, 100)
+        log_file = os.path.join(workdir, 'ip_query_log.csv')
+        started = time.monotonic()
+        generate(log_file, args.rows, distinct, clients=1000, days=30)
+        subprocess.run([sys.executable, os.path.join(REPO_DIR, 'import_query_log.py'), log_file], cwd=workdir, check=True)
+        subprocess.run([sys.executable, '-c', 'import main_server; main_server.setup_query_stats()'],
+                       cwd=workdir, env=dict(os.environ, PYTHONPATH=REPO_DIR), check=True)
+        print(f"Prepared {args.rows} log rows in {time.monotonic() - started:.1f}s")
+
+        if args.mode == 'async':
+            worker_args = ['--worker-class', 'aiohttp.GunicornWebWorker', 'async_server:app']
+        else:
+            worker_args = ['--threads', '2', 'main_server:app']
+        # All load comes from one IP, so admission control would only measure 429s
+        env = dict(os.environ, PEAKPX_URL=upstream.url, RATE_LIMITING='0', STARTUP_MODE=args.startup_mode,
+                   PRELOAD_SHARED_STATE='1' if args.startup_mode == 'preload' else '0')
+        if args.startup_mode == 'preload':
+            worker_args = ['--preload'] + worker_args
+        started = time.monotonic()
+        server = subprocess.Popen(['gunicorn', '--bind', f'127.0.0.1:{args.port}', '--workers', str(args.workers),
+                                   '--pythonpath', REPO_DIR, '--log-level', 'warning'] + worker_args,
+                                  cwd=workdir, env=env)
+        wait_until_ready(args.port)
+        startup = {'ready_seconds': round(time.monotonic() - started, 2),
+                   'master_rss_mb': round(psutil.Process(server.pid).memory_info().rss / 2 ** 20, 1)}
+        print(f"startup: {json.dumps(startup)}")
+
+        results = {}
+        all_scenarios = scenarios(vocabulary(distinct))
+        for name in args.scenario or all_scenarios:
+            results[name] = run_scenario(args.port, all_scenarios[name], args.concurrency, args.duration, server.pid)
+            print(f"{name}: {json.dumps(results[name])}")
+        print(f"Fake PeakPx served {upstream.requests} searches")
+    finally:
+        if server is not None:
+            server.terminate()
+            server.wait(timeout=30)
+        upstream.shutdown()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    report = {'config': {key: value for key, value in vars(args).items() if key not in ('output', 'baseline', 'save_baseline')},
+              'startup': startup, 'results': results}
+    if args.output:
+        with open(args.output, 'w') as file:
+            json.dump(report, file, indent=2)
+    if args.save_baseline:
+        with open(args.baseline, 'w') as file:
+            json.dump(report, file, indent=2)
+        print(f"Saved baseline to {args.baseline}")
+    elif os.path.exists(args.baseline):
+        with open(args.baseline) as file:
+            baseline = json.load(file)
+        if baseline.get('config', {}).get('rows') != args.rows or baseline.get('config', {}).get('mode') != args.mode:
+            print("Baseline was recorded with a different --rows or --mode, comparison may be misleading")
+        regressions = compare(results, baseline['results'], args.tolerance)
+        for regression in regressions:
+            print(f"REGRESSION {regression}")
+        if regressions:
+            sys.exit(1)
+        print("No regressions against the baseline")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,49 @@
+import argparse
+import csv
+from collections import OrderedDict
+from main_server import canonicalize_query, query_log_file
+
+# Hits of an LRU cache of the given size (None for unbounded) over a sequence of keys
+def simulate_cache(keys, maxsize=None):
+    cache = OrderedDict()
+    hits = 0
+    for key in keys:
+        if key in cache:
+            hits += 1
+            cache.move_to_end(key)
+        else:
+            cache[key] = True
+            if maxsize is not None and len(cache) > maxsize:
+                cache.popitem(last=False)
+    return hits
+
+# Compare cache hit rates and distinct keys of the raw, lowercased and canonical query keys
+def report(queries, cache_sizes):
+    key_functions = [
+        ('raw', lambda query: query),
+        ('lowercase', lambda query: query.lower()),
+        ('canonical', lambda query: canonicalize_query(query, fold_plurals=False)),
+        ('canonical+plurals', lambda query: canonicalize_query(query, fold_plurals=True)),
+    ]
+    header = ['key', 'distinct'] + [f'hit rate (lru {size or "unbounded"})' for size in cache_sizes]
+    rows = []
+    for name, key_function in key_functions:
+        keys = [key_function(query) for query in queries]
+        row = [name, str(len(set(keys)))]
+        for size in cache_sizes:
+            row.append(f'{simulate_cache(keys, size) / len(keys):.1%}' if keys else '-')
+        rows.append(row)
+    widths = [max(len(line[i]) for line in [header] + rows) for i in range(len(header))]
+    for line in [header] + rows:
+        print('  '.join(cell.ljust(width) for cell, width in zip(line, widths)).rstrip())
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Report the cache hit rate gained by canonicalizing queries")
+    parser.add_argument('csv_file', nargs='?', default=query_log_file, help="CSV query log to replay")
+    parser.add_argument('--cache-size', type=int, action='append', help="LRU cache size to simulate (repeatable)")
+    args = parser.parse_args()
+
+    with open(args.csv_file, 'r', newline='') as file:
+        queries = [row['Query'] for row in csv.DictReader(file)]
+    print(f"{len(queries)} queries from {args.csv_file}")
+    report(queries, (args.cache_size or [100]) + [None])
@@ -0,0 +1,15 @@
+import argparse
+import logging
+import os
+from main_server import import_csv_log, log_segments, log_dir, query_log_file
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Import a CSV query log into the segmented log store")
+    parser.add_argument('csv_file', nargs='?', default=query_log_file, help="CSV log to import")
+    parser.add_argument('--force', action='store_true', help="import even if the store already has segments")
+    args = parser.parse_args()
+
+    os.makedirs(log_dir, exist_ok=True)
+    if log_segments() and not args.force:
+        parser.error(f"{log_dir} already has segments, use --force to import into them anyway")
+    logging.info(f"Imported {import_csv_log(args.csv_file)} rows from {args.csv_file} into {log_dir}")
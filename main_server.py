@@ -1,28 +1,57 @@
-import subprocess
 import time
+# Start of the import, for the startup report at the end of this module
+import_started = time.monotonic()
+import subprocess
 import csv
 import os
 import signal
 import threading
 import logging
-from flask import Flask, request, jsonify
+from flask import Flask, Response, g, request, jsonify, send_file, stream_with_context
 from flask_cors import CORS
 from PeakPxApi import PeakPx
 import uuid
-import joblib
 import numpy as np
-from sklearn.feature_extraction.text import TfidfVectorizer
-from sklearn.cluster import KMeans
-from sklearn.metrics.pairwise import cosine_similarity
-from cachetools import TTLCache
+from concurrent.futures import ThreadPoolExecutor, wait
 from collections import Counter
-from better_profanity import profanity
+from better_profanity.utils import read_wordlist, get_complete_path_of_file
+from cachetools import LRUCache, TTLCache
 import psutil
 import traceback
+import sqlite3
+import json
+import queue
+import contextlib
+import glob
+import atexit
+import math
+import bisect
+import itertools
+import hashlib
+import fcntl
+import mmap
+import struct
+import unicodedata
+import hmac
+import re
+from array import array
+import requests
+from urllib.parse import urlencode
+from datetime import datetime, timedelta
+import importlib.util
+import gc
+
+# scikit-learn, scipy, joblib and Pillow are imported where they are used: only
+# training, loading the recommendation models and making thumbnails need them,
+# and importing scikit-learn alone takes most of a second
 
 app = Flask(__name__)
 CORS(app)
 px = PeakPx()
+# Upstream base URL override, e.g. for the local stand-in used by bench/
+peakpx_url = os.environ.get('PEAKPX_URL')
+if peakpx_url:
+    px.url = peakpx_url
 
 # Server key
 server_key = "wallartify2024new"
@@ -30,33 +59,955 @@ server_key = "wallartify2024new"
 # Set up logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s:%(message)s')
 
-# Setup CSV file for logging queries
-def setup_csv():
-    csv_file = 'ip_query_log.csv'
-    if not os.path.exists(csv_file):
-        try:
-            with open(csv_file, 'w', newline='') as file:
-                writer = csv.writer(file)
-                writer.writerow(["ID", "IP Address", "Query", "Timestamp", "Response Status"])
-        except Exception as e:
-            logging.error(f"Error setting up CSV file: {e}")
+# Normalized form of a query, sent to PeakPx and used for the search cache key
+# and the query log: NFKC normalized, case folded, whitespace collapsed.
+# The canonical form keys statistics, trending and recommendations; with
+# FOLD_PLURALS=1 it also reduces regular English plurals to the singular
+# ("cats" -> "cat", "beaches" -> "beach", "puppies" -> "puppy"). Folding is off
+# by default since it also mangles names ("los angeles" -> "los angele").
+fold_plurals = os.environ.get('FOLD_PLURALS', '0') == '1'
+PLURAL_EXCEPTIONS = {'news', 'series', 'species', 'lens', 'christmas', 'xmas', 'texas', 'atlas', 'canvas',
+                     'paris', 'vegas', 'mars', 'venus', 'always', 'movies', 'cookies', 'zombies', 'selfies'}
+
+def singularize(word):
+    if len(word) <= 3 or word in PLURAL_EXCEPTIONS or not word.isalpha():
+        return word
+    if word.endswith('ies'):
+        return word[:-3] + 'y'
+    if word.endswith(('sses', 'xes', 'ches', 'shes')):
+        return word[:-2]
+    if word.endswith('s') and not word.endswith(('ss', 'us', 'is')):
+        return word[:-1]
+    return word
+
+def normalize_query(query):
+    return ' '.join(unicodedata.normalize('NFKC', query).casefold().split())
+
+def canonicalize_query(query, fold_plurals=fold_plurals):
+    query = normalize_query(query)
+    if fold_plurals:
+        query = ' '.join(singularize(word) for word in query.split())
+    return query
+
+# Shared state database, read and written by every gunicorn worker
+state_db = 'server_state.db'
+_db_local = threading.local()
+
+STATE_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS query_stats (
+    query TEXT PRIMARY KEY,
+    count INTEGER NOT NULL,
+    updated_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS query_stats_count ON query_stats (count DESC, query);
+CREATE INDEX IF NOT EXISTS query_stats_updated_at ON query_stats (updated_at);
+CREATE TABLE IF NOT EXISTS search_cache (
+    query TEXT PRIMARY KEY,
+    image_urls TEXT NOT NULL,
+    body BLOB NOT NULL,
+    etag TEXT NOT NULL,
+    fetched_at REAL NOT NULL,
+    accessed_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS search_cache_accessed_at ON search_cache (accessed_at);
+CREATE TABLE IF NOT EXISTS search_flights (
+    query TEXT PRIMARY KEY,
+    owner TEXT NOT NULL,
+    expires_at REAL NOT NULL,
+    status TEXT
+);
+CREATE TABLE IF NOT EXISTS trending (
+    window TEXT NOT NULL,
+    query TEXT NOT NULL,
+    score REAL NOT NULL,
+    PRIMARY KEY (window, query)
+);
+CREATE INDEX IF NOT EXISTS trending_score ON trending (window, score DESC);
+CREATE TABLE IF NOT EXISTS counters (
+    name TEXT PRIMARY KEY,
+    value INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS images (
+    source TEXT NOT NULL,
+    width INTEGER NOT NULL,
+    digest TEXT NOT NULL,
+    content_type TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    accessed_at REAL NOT NULL,
+    PRIMARY KEY (source, width)
+);
+CREATE INDEX IF NOT EXISTS images_digest ON images (digest);
+CREATE INDEX IF NOT EXISTS images_accessed ON images (accessed_at);
+CREATE TABLE IF NOT EXISTS health (
+    id INTEGER PRIMARY KEY CHECK (id = 1),
+    snapshot TEXT NOT NULL,
+    updated_at REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS histograms (
+    name TEXT NOT NULL,
+    labels TEXT NOT NULL,
+    bucket TEXT NOT NULL,
+    value REAL NOT NULL,
+    PRIMARY KEY (name, labels, bucket)
+);
+CREATE TABLE IF NOT EXISTS state_meta (
+    name TEXT PRIMARY KEY,
+    value TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS query_rollups (
+    period TEXT NOT NULL,
+    bucket TEXT NOT NULL,
+    query TEXT NOT NULL,
+    count INTEGER NOT NULL,
+    successes INTEGER NOT NULL,
+    clients INTEGER NOT NULL,
+    PRIMARY KEY (period, bucket, query)
+);
+CREATE INDEX IF NOT EXISTS query_rollups_query ON query_rollups (query, period, bucket);
+CREATE TABLE IF NOT EXISTS rollup_checkpoint (
+    id INTEGER PRIMARY KEY CHECK (id = 1),
+    next_hour TEXT NOT NULL,
+    updated_at REAL NOT NULL
+);
+'''
+
+def get_db():
+    # One connection per thread, reopened after a fork
+    conn = getattr(_db_local, 'conn', None)
+    if conn is None or _db_local.pid != os.getpid():
+        conn = sqlite3.connect(state_db, timeout=30, isolation_level=None)
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=NORMAL')
+        conn.executescript(STATE_SCHEMA)
+        _db_local.conn = conn
+        _db_local.pid = os.getpid()
+    return conn
+
+# Close this thread's connection; SQLite connections must not be carried across a fork
+def close_db():
+    conn = getattr(_db_local, 'conn', None)
+    if conn is not None:
+        conn.close()
+        _db_local.conn = None
+
+def read_counters(prefix):
+    return dict(get_db().execute('SELECT name, value FROM counters WHERE name LIKE ? ORDER BY name', (prefix + '%',)))
+
+# Run the statements of a with-block in one write transaction
+@contextlib.contextmanager
+def transaction(db):
+    db.execute('BEGIN IMMEDIATE')
+    try:
+        yield db
+        db.execute('COMMIT')
+    except Exception:
+        db.execute('ROLLBACK')
+        raise
+
+# Metrics: counters and latency histograms are accumulated in memory by each
+# process and merged into the shared counters/histograms tables every
+# metrics_flush_interval seconds, so /metrics reports totals over all workers.
+metric_prefix = 'wallartify_'
+metric_buckets = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+metric_bucket_labels = [f'{bucket:g}' for bucket in metric_buckets] + ['+Inf']
+metrics_flush_interval = 5.0
+metrics_lock = threading.Lock()
+pending_counters = Counter()
+pending_histograms = {}
+metrics_flusher = None
+
+def increment_counter(name, amount=1):
+    start_metrics_flusher()
+    with metrics_lock:
+        pending_counters[name] += amount
+
+# Record one observation, in seconds, in a histogram
+def observe(name, seconds, **labels):
+    start_metrics_flusher()
+    key = (name, ','.join(f'{label}="{escape_label(value)}"' for label, value in sorted(labels.items())))
+    with metrics_lock:
+        entry = pending_histograms.get(key)
+        if entry is None:
+            # Per-bucket counts (the last one is +Inf) followed by the sum
+            entry = pending_histograms[key] = [0] * (len(metric_buckets) + 2)
+        entry[bisect.bisect_left(metric_buckets, seconds)] += 1
+        entry[-1] += seconds
+
+def escape_label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+# Time a with-block, or every call when used as a decorator
+@contextlib.contextmanager
+def timed(name, **labels):
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe(name, time.perf_counter() - started, **labels)
+
+# Start the flusher in this process; a forked worker drops the values copied
+# from its parent, which flushes them itself
+def start_metrics_flusher():
+    global metrics_flusher, pending_histograms
+    if metrics_flusher is not None and metrics_flusher.pid == os.getpid():
+        return
+    with metrics_lock:
+        if metrics_flusher is None or metrics_flusher.pid != os.getpid():
+            if metrics_flusher is not None:
+                pending_counters.clear()
+                pending_histograms = {}
+            metrics_flusher = threading.Thread(target=run_metrics_flusher, daemon=True)
+            metrics_flusher.pid = os.getpid()
+            metrics_flusher.start()
+
+def run_metrics_flusher():
+    while True:
+        time.sleep(metrics_flush_interval)
+        flush_metrics()
+
+# Merge this process's metrics into the shared tables
+@atexit.register
+def flush_metrics():
+    global pending_histograms
+    with metrics_lock:
+        counters, histograms = list(pending_counters.items()), pending_histograms
+        pending_counters.clear()
+        pending_histograms = {}
+    if not counters and not histograms:
+        return
+    rows = []
+    for (name, labels), entry in histograms.items():
+        rows.extend((name, labels, bucket, count) for bucket, count in zip(metric_bucket_labels, entry) if count)
+        rows.append((name, labels, 'sum', entry[-1]))
+    try:
+        with transaction(get_db()) as db:
+            db.executemany('INSERT INTO counters (name, value) VALUES (?, ?) '
+                           'ON CONFLICT (name) DO UPDATE SET value = value + excluded.value', counters)
+            db.executemany('INSERT INTO histograms (name, labels, bucket, value) VALUES (?, ?, ?, ?) '
+                           'ON CONFLICT (name, labels, bucket) DO UPDATE SET value = value + excluded.value', rows)
+    except Exception as e:
+        logging.error(f"Error flushing metrics: {e}")
+
+# All workers' metrics in the Prometheus text exposition format
+def render_metrics():
+    flush_metrics()
+    db = get_db()
+    lines = []
+    for name, value in db.execute('SELECT name, value FROM counters ORDER BY name'):
+        lines.append(f'# TYPE {metric_prefix}{name}_total counter')
+        lines.append(f'{metric_prefix}{name}_total {value}')
+    histograms = {}
+    for name, labels, bucket, value in db.execute('SELECT name, labels, bucket, value FROM histograms'):
+        histograms.setdefault(name, {}).setdefault(labels, {})[bucket] = value
+    for name, series in sorted(histograms.items()):
+        metric = metric_prefix + name
+        lines.append(f'# TYPE {metric} histogram')
+        for labels, values in sorted(series.items()):
+            total = 0
+            for bucket in metric_bucket_labels:
+                total += int(values.get(bucket, 0))
+                lines.append(f'{metric}_bucket{{{labels + "," if labels else ""}le="{bucket}"}} {total}')
+            selector = f'{{{labels}}}' if labels else ''
+            lines.append(f'{metric}_sum{selector} {values.get("sum", 0):.6f}')
+            lines.append(f'{metric}_count{selector} {total}')
+    return '\n'.join(lines) + '\n'
+
+# Build the query statistics from the query log once, when the store is empty,
+# or re-key them when the canonical form changed
+def setup_query_stats():
+    try:
+        db = get_db()
+        if db.execute('SELECT 1 FROM query_stats LIMIT 1').fetchone():
+            migrate_canonical_queries()
+            return
+        record_canonical_form(db)
+        query_counter = load_query_counts()
+        with transaction(db):
+            now = time.time()
+            db.executemany('INSERT OR IGNORE INTO query_stats (query, count, updated_at) VALUES (?, ?, ?)',
+                           ((query, count, now) for query, count in query_counter.items()))
+        logging.info(f"Loaded statistics for {len(query_counter)} distinct queries")
+    except Exception as e:
+        logging.error(f"Error setting up query statistics: {e}")
+
+def canonical_form():
+    return 'fold_plurals' if fold_plurals else 'normalized'
+
+def record_canonical_form(db):
+    db.execute("INSERT OR REPLACE INTO state_meta (name, value) VALUES ('canonical_form', ?)", (canonical_form(),))
+
+# Merge the query_stats and trending rows whose queries have the same canonical
+# form, once per change of the form (and once for stores from before it was
+# recorded), so that e.g. old "cats" counts are not split from new "cat" ones
+def migrate_canonical_queries():
+    db = get_db()
+    with transaction(db):
+        row = db.execute("SELECT value FROM state_meta WHERE name = 'canonical_form'").fetchone()
+        if row and row[0] == canonical_form():
+            return
+        counts = Counter()
+        for query, count in db.execute('SELECT query, count FROM query_stats').fetchall():
+            counts[canonicalize_query(query)] += count
+        # Stamped anew, so running indexes pick up the merged counts
+        now = time.time()
+        db.execute('DELETE FROM query_stats')
+        db.executemany('INSERT INTO query_stats (query, count, updated_at) VALUES (?, ?, ?)',
+                       ((query, count, now) for query, count in counts.items()))
+        scores = {}
+        for window, query, score in db.execute('SELECT window, query, score FROM trending').fetchall():
+            key = (window, canonicalize_query(query))
+            scores[key] = logaddexp(scores[key], score) if key in scores else score
+        db.execute('DELETE FROM trending')
+        db.executemany('INSERT INTO trending (window, query, score) VALUES (?, ?, ?)',
+                       ((window, query, score) for (window, query), score in scores.items()))
+        record_canonical_form(db)
+    logging.info(f"Re-keyed query statistics as {canonical_form()}, {len(counts)} distinct queries")
+
+# Add a batch of logged queries, given as a Counter, to their counts. Rows are
+# stamped once the write lock is held, so stamps follow commit order and a
+# sync cannot pass a row that commits after it.
+def record_query_stats(query_counter):
+    db = get_db()
+    with transaction(db):
+        now = time.time()
+        db.executemany('INSERT INTO query_stats (query, count, updated_at) VALUES (?, ?, ?) '
+                       'ON CONFLICT (query) DO UPDATE SET count = count + excluded.count, updated_at = excluded.updated_at',
+                       ((query, count, now) for query, count in query_counter.items()))
+
+# Most frequently logged queries, as (query, count) pairs
+def top_queries(n=10):
+    return get_db().execute('SELECT query, count FROM query_stats ORDER BY count DESC, query LIMIT ?', (n,)).fetchall()
+
+# Trending windows: every query has an exponentially decayed count per window,
+# with the window length as the decay time constant. Scores are stored as
+# log(count) + t / window, which orders rows the same way at any later time,
+# so decay is only applied when a count is read. Each window keeps at most
+# trending_capacity queries, Space-Saving style: when full, a new query takes
+# the place of the lowest one and inherits its count.
+trending_windows = {'hour': 3600, 'day': 86400, 'week': 7 * 86400}
+trending_capacity = 10000
+
+def logaddexp(a, b):
+    high, low = max(a, b), min(a, b)
+    return high + math.log1p(math.exp(low - high))
+
+# Add a batch of logged queries, given as a Counter, to every trending window
+def record_trending(query_counter):
+    now = time.time()
+    db = get_db()
+    with transaction(db):
+        for window, seconds in trending_windows.items():
+            size = db.execute('SELECT COUNT(*) FROM trending WHERE window = ?', (window,)).fetchone()[0]
+            for query, count in query_counter.items():
+                increment = math.log(count) + now / seconds
+                row = db.execute('SELECT score FROM trending WHERE window = ? AND query = ?', (window, query)).fetchone()
+                if row:
+                    db.execute('UPDATE trending SET score = ? WHERE window = ? AND query = ?',
+                               (logaddexp(row[0], increment), window, query))
+                    continue
+                if size >= trending_capacity:
+                    lowest, score = db.execute('SELECT query, score FROM trending WHERE window = ? '
+                                               'ORDER BY score LIMIT 1', (window,)).fetchone()
+                    db.execute('DELETE FROM trending WHERE window = ? AND query = ?', (window, lowest))
+                    increment = logaddexp(score, increment)
+                else:
+                    size += 1
+                db.execute('INSERT INTO trending (window, query, score) VALUES (?, ?, ?)', (window, query, increment))
+
+# Top queries of a window with their decayed counts, or all-time counts for 'all'
+def trending_queries(window='all', n=10):
+    if window == 'all':
+        return top_queries(n)
+    if window not in trending_windows:
+        raise ValueError(f"Invalid window, expected one of: all, {', '.join(trending_windows)}")
+    offset = time.time() / trending_windows[window]
+    rows = get_db().execute('SELECT query, score FROM trending WHERE window = ? ORDER BY score DESC LIMIT ?', (window, n))
+    return [(query, round(math.exp(score - offset), 2)) for query, score in rows]
+
+# Stable client IDs: a keyed BLAKE2b hash of the IP, formatted as a UUID, so an
+# IP gets the same ID in every worker and across restarts without any state.
+# The secret comes from CLIENT_ID_KEY or, when unset, from client_id_key_file,
+# created on first use. With CLIENT_ID_ROTATION_DAYS set, IDs change every
+# that many days, so they cannot be linked across periods.
+client_id_key_file = 'client_id.key'
+client_id_rotation_days = int(os.environ.get('CLIENT_ID_ROTATION_DAYS', '0'))
+
+def load_client_id_key():
+    secret = os.environ.get('CLIENT_ID_KEY')
+    if secret:
+        return hashlib.sha256(secret.encode('utf-8')).digest()
+    try:
+        with open(client_id_key_file, 'rb') as file:
+            return file.read()
+    except FileNotFoundError:
+        pass
+    # Link a fully written temporary file into place, so concurrent workers agree on one key
+    tmp_file = f'{client_id_key_file}.{os.getpid()}.tmp'
+    with open(tmp_file, 'wb') as file:
+        file.write(os.urandom(32))
+    os.chmod(tmp_file, 0o600)
+    try:
+        os.link(tmp_file, client_id_key_file)
+    except FileExistsError:
+        pass
+    finally:
+        os.remove(tmp_file)
+    with open(client_id_key_file, 'rb') as file:
+        return file.read()
+
+class ClientIds:
+    def __init__(self, rotation_days=0):
+        self.rotation = rotation_days * 86400
+        self.key = None
+        self.period_key = (None, None)
+
+    def get(self, ip_address, now=None):
+        now = time.time() if now is None else now
+        period = int(now // self.rotation) if self.rotation else 0
+        current, key = self.period_key
+        if current != period:
+            if self.key is None:
+                self.key = load_client_id_key()
+            key = hashlib.blake2b(str(period).encode('ascii'), key=self.key, digest_size=32).digest()
+            self.period_key = (period, key)
+        digest = hashlib.blake2b(ip_address.encode('utf-8'), key=key, digest_size=16).digest()
+        return str(uuid.UUID(bytes=digest))
 
-# Dictionary to store client IPs and their corresponding IDs
-client_ids = {}
+client_ids = ClientIds(client_id_rotation_days)
 
-# Log query to CSV
-def log_query(ip_address, query, response_success, file):
+# Query log records are queued by log_query and appended to the log store in
+# batches by a background flusher in each worker, once log_flush_records are
+# queued or log_flush_interval seconds have passed.
+log_buffer_size = 10000
+log_flush_records = 500
+log_flush_interval = 1.0
+# When the buffer is full: 'block' waits for the flusher, 'drop_newest' discards
+# the new record and 'drop_oldest' discards the oldest queued record
+log_full_policy = os.environ.get('QUERY_LOG_FULL_POLICY', 'block')
+log_queue = queue.Queue(maxsize=log_buffer_size)
+log_flusher = None
+log_flusher_lock = threading.Lock()
+
+# Log query to the log store; callers that must not block (an event loop) pass a drop policy
+@timed('function_duration_seconds', function='log_query')
+def log_query(ip_address, query, response_success, policy=None):
     try:
-        if (client_id := client_ids.get(ip_address)) is None:
-            client_id = str(uuid.uuid4())
-            client_ids[ip_address] = client_id
-        unique_id = client_id
-        writer = csv.writer(file)
+        client_id = client_ids.get(ip_address or '')
         timestamp = time.strftime('%Y-%m-%d %H:%M:%S')
-        writer.writerow([unique_id, ip_address, query.lower(), timestamp, response_success])
+        enqueue_log_record([client_id, ip_address, normalize_query(query), timestamp, response_success], policy or log_full_policy)
     except Exception as e:
         logging.error(f"Error logging query: {e}")
 
+def enqueue_log_record(record, policy=log_full_policy):
+    start_log_flusher()
+    if policy == 'block':
+        log_queue.put(record)
+        return
+    while True:
+        try:
+            log_queue.put_nowait(record)
+            return
+        except queue.Full:
+            increment_counter('query_log_dropped')
+            if policy != 'drop_oldest':
+                return
+        try:
+            log_queue.get_nowait()
+        except queue.Empty:
+            pass
+
+# Start the flusher in this process; a forked worker starts its own
+def start_log_flusher():
+    global log_flusher
+    if log_flusher is not None and log_flusher.pid == os.getpid():
+        return
+    with log_flusher_lock:
+        if log_flusher is None or log_flusher.pid != os.getpid():
+            log_flusher = threading.Thread(target=run_log_flusher, daemon=True)
+            log_flusher.pid = os.getpid()
+            log_flusher.start()
+
+def run_log_flusher():
+    while True:
+        record = log_queue.get()
+        if record is None:
+            return
+        batch = [record]
+        deadline = time.monotonic() + log_flush_interval
+        while len(batch) < log_flush_records:
+            try:
+                record = log_queue.get(timeout=max(deadline - time.monotonic(), 0))
+            except queue.Empty:
+                break
+            if record is None:
+                write_log_batch(batch)
+                return
+            batch.append(record)
+        write_log_batch(batch)
+
+@timed('function_duration_seconds', function='write_log_batch')
+def write_log_batch(batch):
+    try:
+        append_log_records(batch)
+        query_counter = Counter(canonicalize_query(record[2]) for record in batch)
+        record_query_stats(query_counter)
+        record_trending(query_counter)
+    except Exception as e:
+        logging.error(f"Error writing query log batch of {len(batch)} records: {e}")
+
+# Write out whatever is still queued when the worker exits
+@atexit.register
+def stop_log_flusher():
+    if log_flusher is not None and log_flusher.pid == os.getpid() and log_flusher.is_alive():
+        try:
+            log_queue.put(None, timeout=5)
+            log_flusher.join(timeout=10)
+        except queue.Full:
+            logging.error("Query log buffer still full at exit, dropping queued records")
+
+# The query log is stored in SQLite segments under log_dir, one per day, named
+# YYYY-MM-DD.db and indexed on timestamp, client ID and query. Days older than
+# log_compact_after_days are merged into one YYYY-MM.db segment per month, and
+# segments older than log_retention_days are deleted (0 keeps them forever).
+log_dir = 'query_logs'
+log_compact_after_days = 7
+log_retention_days = int(os.environ.get('LOG_RETENTION_DAYS', '0'))
+# Legacy CSV log, imported into the segments once
+query_log_file = 'ip_query_log.csv'
+_segment_local = threading.local()
+
+LOG_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS logs (
+    id INTEGER PRIMARY KEY,
+    client_id TEXT NOT NULL,
+    ip TEXT NOT NULL,
+    query TEXT NOT NULL,
+    timestamp TEXT NOT NULL,
+    success INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS logs_timestamp ON logs (timestamp);
+CREATE INDEX IF NOT EXISTS logs_client_id ON logs (client_id);
+CREATE INDEX IF NOT EXISTS logs_query ON logs (query);
+CREATE TABLE IF NOT EXISTS compacted (
+    segment TEXT PRIMARY KEY
+);
+'''
+
+def open_segment(name):
+    conn = sqlite3.connect(os.path.join(log_dir, f'{name}.db'), timeout=30, isolation_level=None)
+    conn.execute('PRAGMA journal_mode=WAL')
+    conn.execute('PRAGMA synchronous=NORMAL')
+    conn.executescript(LOG_SCHEMA)
+    return conn
+
+# Writable connection to a segment, cached per thread
+def segment_db(name):
+    if getattr(_segment_local, 'pid', None) != os.getpid():
+        _segment_local.conns = {}
+        _segment_local.pid = os.getpid()
+    conns = _segment_local.conns
+    if name not in conns:
+        # Only the current day or two are written to, drop older connections
+        while len(conns) >= 4:
+            conns.pop(min(conns)).close()
+        os.makedirs(log_dir, exist_ok=True)
+        conns[name] = open_segment(name)
+    return conns[name]
+
+# First and last day covered by a segment name
+def segment_days(name):
+    if len(name) == 7:
+        return f'{name}-01', f'{name}-31'
+    return name, name
+
+# Segment names overlapping the given days (YYYY-MM-DD, inclusive), oldest first
+def log_segments(start_day=None, end_day=None):
+    names = []
+    for path in glob.glob(os.path.join(log_dir, '*.db')):
+        name = os.path.basename(path)[:-3]
+        first, last = segment_days(name)
+        if (start_day is None or last >= start_day) and (end_day is None or first <= end_day):
+            names.append(name)
+    return sorted(names, key=lambda name: segment_days(name)[0])
+
+# Append [client_id, ip, query, timestamp, success] records to their day's segment
+def append_log_records(records):
+    by_day = {}
+    for record in records:
+        by_day.setdefault(record[3][:10], []).append(record)
+    for day, rows in sorted(by_day.items()):
+        db = segment_db(day)
+        with transaction(db):
+            db.executemany('INSERT INTO logs (client_id, ip, query, timestamp, success) VALUES (?, ?, ?, ?, ?)',
+                           ((client_id, ip, query, timestamp, 1 if str(success) == 'True' else 0)
+                            for client_id, ip, query, timestamp, success in rows))
+
+# Filters accepted by /view_logs: start/end are a day (YYYY-MM-DD) or a
+# timestamp (YYYY-MM-DD HH:MM:SS), query matches a substring, success is true/false
+def parse_log_filters(args):
+    filters = {}
+    for name in ('start', 'end'):
+        value = args.get(name)
+        if value:
+            try:
+                time.strptime(value, '%Y-%m-%d' if len(value) == 10 else '%Y-%m-%d %H:%M:%S')
+            except ValueError:
+                raise ValueError(f"Invalid {name}, expected YYYY-MM-DD or YYYY-MM-DD HH:MM:SS")
+            filters[name] = value
+    for name in ('ip', 'client_id', 'query'):
+        if args.get(name):
+            filters[name] = args.get(name)
+    success = args.get('success')
+    if success:
+        if success.lower() not in ('true', 'false'):
+            raise ValueError("Invalid success, expected true or false")
+        filters['success'] = success.lower() == 'true'
+    return filters
+
+# A cursor is "<segment>:<row id>" of the last row already returned, the
+# segment being a day (YYYY-MM-DD) or a month (YYYY-MM)
+SEGMENT_NAME = re.compile(r'\d{4}-\d{2}(-\d{2})?')
+
+def parse_log_cursor(value):
+    if not value:
+        return None
+    name, _, row_id = value.rpartition(':')
+    if not SEGMENT_NAME.fullmatch(name) or not row_id.isdigit():
+        raise ValueError("Invalid cursor")
+    try:
+        time.strptime(name, '%Y-%m-%d' if len(name) == 10 else '%Y-%m')
+    except ValueError:
+        raise ValueError("Invalid cursor")
+    return name, int(row_id)
+
+# A cursor into a day segment compacted since then points into its month: the
+# day's rows were copied there in order, so its row n became the month's first
+# row of that day plus n - 1
+def compacted_cursor(after):
+    name, row_id = after
+    if len(name) != 10 or os.path.exists(os.path.join(log_dir, f'{name}.db')):
+        return after
+    if not os.path.exists(os.path.join(log_dir, f'{name[:7]}.db')):
+        return after
+    conn = open_segment(name[:7])
+    try:
+        first = conn.execute('SELECT MIN(id) FROM logs WHERE timestamp >= ? AND timestamp < ?', (name, f'{name}~')).fetchone()[0]
+        if first is None:
+            first = conn.execute('SELECT COALESCE(MAX(id), 0) + 1 FROM logs WHERE timestamp < ?', (name,)).fetchone()[0]
+    finally:
+        conn.close()
+    return name[:7], first + row_id - 1
+
+# (cursor, row) pairs in log order, matching the filters and following the cursor
+def iter_log_rows(filters=None, after=None):
+    filters = filters or {}
+    if after is not None:
+        after = compacted_cursor(after)
+    conditions, params = [], []
+    if 'start' in filters:
+        conditions.append('timestamp >= ?')
+        params.append(filters['start'])
+    if 'end' in filters:
+        conditions.append('timestamp <= ?')
+        # A bare day includes every timestamp on that day
+        params.append(filters['end'] + '~' if len(filters['end']) == 10 else filters['end'])
+    for name, column in (('ip', 'ip'), ('client_id', 'client_id')):
+        if name in filters:
+            conditions.append(f'{column} = ?')
+            params.append(filters[name])
+    if 'query' in filters:
+        conditions.append('instr(query, ?) > 0')
+        params.append(normalize_query(filters['query']))
+        # With FOLD_PLURALS=1 the folded form matches too, as statistics count it together
+        folded = canonicalize_query(filters['query'])
+        if folded != params[-1]:
+            conditions[-1] = '(instr(query, ?) > 0 OR instr(query, ?) > 0)'
+            params.append(folded)
+    if 'success' in filters:
+        conditions.append('success = ?')
+        params.append(1 if filters['success'] else 0)
+
+    start_day = filters['start'][:10] if 'start' in filters else None
+    end_day = filters['end'][:10] if 'end' in filters else None
+    for name in log_segments(start_day, end_day):
+        segment_conditions, segment_params = list(conditions), list(params)
+        if after is not None:
+            if segment_days(name)[0] < segment_days(after[0])[0]:
+                continue
+            if name == after[0]:
+                segment_conditions.append('id > ?')
+                segment_params.append(after[1])
+        where = f"WHERE {' AND '.join(segment_conditions)}" if segment_conditions else ''
+        conn = open_segment(name)
+        try:
+            sql = f'SELECT id, client_id, ip, query, timestamp, success FROM logs {where} ORDER BY id'
+            for row in conn.execute(sql, segment_params):
+                yield f'{name}:{row[0]}', {'ID': row[1], 'IP Address': row[2], 'Query': row[3], 'Timestamp': row[4],
+                                           'Response Success': 'True' if row[5] else 'False'}
+        finally:
+            conn.close()
+
+# Query counts over the given days (YYYY-MM-DD, inclusive)
+def load_query_counts(start_day=None, end_day=None):
+    return Counter({query: count for query, (count, _, _) in load_query_aggregates(start_day, end_day).items()})
+
+# Merge old daily segments into monthly ones and drop segments past retention
+def compact_log_segments():
+    today = time.strftime('%Y-%m-%d')
+    compact_before = time.strftime('%Y-%m-%d', time.localtime(time.time() - log_compact_after_days * 86400))
+    for name in log_segments():
+        if len(name) != 10 or name >= compact_before or name >= today:
+            continue
+        try:
+            month = open_segment(name[:7])
+            try:
+                month.execute('ATTACH DATABASE ? AS day', (os.path.join(log_dir, f'{name}.db'),))
+                try:
+                    with transaction(month):
+                        if month.execute('SELECT 1 FROM compacted WHERE segment = ?', (name,)).fetchone():
+                            # Copied before, by a run that crashed before deleting the day or
+                            # ahead of rows logged late: only copy what the month lacks
+                            month.execute('INSERT INTO logs (client_id, ip, query, timestamp, success) '
+                                          'SELECT client_id, ip, query, timestamp, success FROM day.logs AS d '
+                                          'WHERE NOT EXISTS (SELECT 1 FROM main.logs AS m WHERE m.timestamp = d.timestamp '
+                                          'AND m.client_id = d.client_id AND m.ip = d.ip AND m.query = d.query '
+                                          'AND m.success = d.success) ORDER BY id')
+                        else:
+                            month.execute('INSERT INTO logs (client_id, ip, query, timestamp, success) '
+                                          'SELECT client_id, ip, query, timestamp, success FROM day.logs ORDER BY id')
+                            month.execute('INSERT INTO compacted (segment) VALUES (?)', (name,))
+                finally:
+                    month.execute('DETACH DATABASE day')
+            finally:
+                month.close()
+            for suffix in ('.db', '.db-wal', '.db-shm'):
+                with contextlib.suppress(FileNotFoundError):
+                    os.remove(os.path.join(log_dir, name + suffix))
+            logging.info(f"Compacted query log segment {name}")
+        except Exception as e:
+            logging.error(f"Error compacting query log segment {name}: {e}")
+    if log_retention_days:
+        keep_from = time.strftime('%Y-%m-%d', time.localtime(time.time() - log_retention_days * 86400))
+        for name in log_segments(end_day=keep_from):
+            if segment_days(name)[1] < keep_from:
+                for suffix in ('.db', '.db-wal', '.db-shm'):
+                    with contextlib.suppress(FileNotFoundError):
+                        os.remove(os.path.join(log_dir, name + suffix))
+                logging.info(f"Deleted query log segment {name}")
+
+def run_log_compaction(interval=3600):
+    while True:
+        compact_log_segments()
+        time.sleep(interval)
+
+# Copy a CSV query log into the segments, in batches
+def import_csv_log(filename, batch_size=50000):
+    imported, earliest = 0, None
+    with open(filename, 'r', newline='') as file:
+        batch = []
+        for row in csv.DictReader(file):
+            batch.append([row['ID'], row['IP Address'], normalize_query(row['Query']), row['Timestamp'], row['Response Status']])
+            if earliest is None or row['Timestamp'] < earliest:
+                earliest = row['Timestamp']
+            if len(batch) == batch_size:
+                append_log_records(batch)
+                imported += len(batch)
+                batch = []
+        append_log_records(batch)
+        imported += len(batch)
+    # Hours that were already rolled up are rolled up again with the imported rows
+    if earliest is not None:
+        rewind_query_rollups(earliest[:13])
+    return imported
+
+# Import the legacy CSV log when the segment store is still empty
+def setup_log_store():
+    try:
+        os.makedirs(log_dir, exist_ok=True)
+        if not log_segments() and os.path.exists(query_log_file):
+            logging.info(f"Imported {import_csv_log(query_log_file)} rows from {query_log_file}")
+    except Exception as e:
+        logging.error(f"Error setting up query log store: {e}")
+
+# Query rollups: complete hours of the query log are aggregated into one row per
+# query and hour, and per query and day once the day's last hour is in, holding
+# the count, successes and distinct clients. rollup_checkpoint holds the first
+# hour not rolled up yet; every run continues from there up to rollup_delay
+# seconds ago, so records still queued in a worker's log buffer are written
+# before their hour is read and no row is read twice. Readers take the days
+# before the checkpoint from the daily rows and only scan the log after it, so
+# their cost grows with distinct queries instead of searches. Daily rows are
+# kept after their log segments expire, hourly ones for rollup_hourly_days.
+rollup_delay = 300
+rollup_interval = 300
+rollup_hourly_days = 31
+rollup_max_limit = 1000
+
+def hour_after(hour, hours=1):
+    return (datetime.strptime(hour, '%Y-%m-%d %H') + timedelta(hours=hours)).strftime('%Y-%m-%d %H')
+
+# First hour ('YYYY-MM-DD HH') not rolled up yet, or None before the first run
+def rollup_checkpoint(db=None):
+    row = (db or get_db()).execute('SELECT next_hour FROM rollup_checkpoint WHERE id = 1').fetchone()
+    return row[0] if row else None
+
+# Roll up the hours from the given one again, e.g. after importing older log rows
+def rewind_query_rollups(hour):
+    get_db().execute('UPDATE rollup_checkpoint SET next_hour = ?, updated_at = ? WHERE next_hour > ?',
+                     (hour, time.time(), hour))
+
+# {(bucket, query): [count, successes, clients]} of the log rows in [start, end),
+# with buckets of the first bucket_length characters of the timestamp
+def aggregate_log_rows(names, start, end, bucket_length):
+    aggregates = {}
+    for name in names:
+        conn = open_segment(name)
+        try:
+            sql = ('SELECT substr(timestamp, 1, ?), query, COUNT(*), SUM(success), COUNT(DISTINCT client_id) '
+                   'FROM logs WHERE timestamp >= ? AND timestamp < ? GROUP BY 1, 2')
+            for bucket, query, count, successes, clients in conn.execute(sql, (bucket_length, start, end)):
+                entry = aggregates.setdefault((bucket, query), [0, 0, 0])
+                entry[0] += count
+                entry[1] += successes
+                entry[2] += clients
+        finally:
+            conn.close()
+    return aggregates
+
+# Roll up the complete hours logged since the checkpoint, one day per transaction;
+# returns the number of hours rolled up
+@timed('function_duration_seconds', function='rollup_query_log')
+def rollup_query_log(now=None):
+    now = time.time() if now is None else now
+    end_hour = time.strftime('%Y-%m-%d %H', time.localtime(now - rollup_delay))
+    db = get_db()
+    checkpoint = rollup_checkpoint(db)
+    segments = log_segments()
+    start_hour = checkpoint
+    if start_hour is None:
+        if not segments:
+            return 0
+        conn = open_segment(segments[0])
+        try:
+            first = conn.execute('SELECT MIN(timestamp) FROM logs').fetchone()[0]
+        finally:
+            conn.close()
+        if first is None:
+            return 0
+        start_hour = first[:13]
+    hours = 0
+    while start_hour < end_hour:
+        day = start_hour[:10]
+        next_day = hour_after(f'{day} 00', 24)
+        stop_hour = min(end_hour, next_day)
+        names = [name for name in segments if segment_days(name)[0] <= day <= segment_days(name)[1]]
+        rows = [('hour', bucket, query, *entry) for (bucket, query), entry in
+                aggregate_log_rows(names, start_hour, stop_hour, 13).items()]
+        if stop_hour == next_day:
+            rows.extend(('day', bucket, query, *entry) for (bucket, query), entry in
+                        aggregate_log_rows(names, f'{day} 00', next_day, 10).items())
+        with transaction(db):
+            # Another process got here first
+            if rollup_checkpoint(db) != checkpoint:
+                break
+            db.executemany('INSERT OR REPLACE INTO query_rollups (period, bucket, query, count, successes, clients) '
+                           'VALUES (?, ?, ?, ?, ?, ?)', rows)
+            db.execute('INSERT INTO rollup_checkpoint (id, next_hour, updated_at) VALUES (1, ?, ?) '
+                       'ON CONFLICT (id) DO UPDATE SET next_hour = excluded.next_hour, updated_at = excluded.updated_at',
+                       (stop_hour, now))
+        hours += int((datetime.strptime(stop_hour, '%Y-%m-%d %H') - datetime.strptime(start_hour, '%Y-%m-%d %H')).total_seconds() // 3600)
+        checkpoint = start_hour = stop_hour
+    keep_from = time.strftime('%Y-%m-%d %H', time.localtime(now - rollup_hourly_days * 86400))
+    db.execute("DELETE FROM query_rollups WHERE period = 'hour' AND bucket < ?", (keep_from,))
+    return hours
+
+def run_query_rollups(interval=rollup_interval):
+    while True:
+        try:
+            hours = rollup_query_log()
+            if hours:
+                logging.info(f"Rolled up {hours} hours of the query log")
+        except Exception as e:
+            logging.error(f"Error rolling up the query log: {e}")
+        time.sleep(interval)
+
+# {query: [count, successes, clients]} over the given days (YYYY-MM-DD, inclusive),
+# clients being summed over days; days before the checkpoint come from the rollups.
+# Queries are keyed by their canonical form, or as logged with canonical=False.
+@timed('function_duration_seconds', function='load_query_aggregates')
+def load_query_aggregates(start_day=None, end_day=None, canonical=True):
+    aggregates = {}
+
+    def add(query, count, successes, clients):
+        entry = aggregates.setdefault(canonicalize_query(query) if canonical else query, [0, 0, 0])
+        entry[0] += count
+        entry[1] += successes
+        entry[2] += clients
+
+    db = get_db()
+    checkpoint = rollup_checkpoint(db)
+    rolled_until = checkpoint[:10] if checkpoint else ''
+    if rolled_until and (start_day or '') < rolled_until:
+        sql = ("SELECT query, SUM(count), SUM(successes), SUM(clients) FROM query_rollups "
+               "WHERE period = 'day' AND bucket >= ? AND bucket <= ? AND bucket < ? GROUP BY query")
+        for row in db.execute(sql, (start_day or '', end_day or '~', rolled_until)):
+            add(*row)
+    log_start = max(start_day or '', rolled_until)
+    if end_day is None or log_start <= end_day:
+        for name in log_segments(log_start or None, end_day):
+            conn = open_segment(name)
+            try:
+                sql = ('SELECT query, COUNT(*), SUM(success), COUNT(DISTINCT client_id) FROM logs '
+                       'WHERE timestamp >= ? AND timestamp < ? GROUP BY query')
+                for row in conn.execute(sql, (log_start, f'{end_day}~' if end_day else '~')):
+                    add(*row)
+            finally:
+                conn.close()
+    return aggregates
+
+# {query as logged: count} over the last seconds of the query log
+def recent_query_counts(seconds):
+    since = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(time.time() - seconds))
+    counts = Counter()
+    for name in log_segments(since[:10]):
+        conn = open_segment(name)
+        try:
+            counts.update(dict(conn.execute('SELECT query, COUNT(*) FROM logs WHERE timestamp >= ? GROUP BY query', (since,))))
+        finally:
+            conn.close()
+    return counts
+
+# (period, start day, end day, query, limit) accepted by /query_rollups
+def parse_rollup_filters(args):
+    period = args.get('period', 'day')
+    if period not in ('hour', 'day'):
+        raise ValueError("Invalid period, expected hour or day")
+    days = []
+    for name in ('start', 'end'):
+        value = args.get(name) or None
+        if value is not None:
+            try:
+                time.strptime(value, '%Y-%m-%d')
+            except ValueError:
+                raise ValueError(f"Invalid {name}, expected YYYY-MM-DD")
+        days.append(value)
+    query = normalize_query(args['query']) if args.get('query') else None
+    limit = args.get('limit', '100')
+    if not limit.isdigit() or not 0 < int(limit) <= rollup_max_limit:
+        raise ValueError(f"Invalid limit, expected 1 to {rollup_max_limit}")
+    return period, days[0], days[1], query, int(limit)
+
+# Rollup rows of a period ('hour' or 'day') between two days, newest first
+def query_rollups(period='day', start_day=None, end_day=None, query=None, limit=100):
+    conditions, params = ['period = ?', 'bucket >= ?', 'bucket < ?'], [period, start_day or '', f'{end_day}~' if end_day else '~']
+    if query is not None:
+        conditions.append('query = ?')
+        params.append(query)
+    sql = (f"SELECT bucket, query, count, successes, clients FROM query_rollups WHERE {' AND '.join(conditions)} "
+           "ORDER BY bucket DESC, count DESC, query LIMIT ?")
+    return [{period: bucket, 'query': query, 'count': count, 'success_ratio': round(successes / count, 4), 'clients': clients}
+            for bucket, query, count, successes, clients in get_db().execute(sql, params + [limit])]
+
 # Validate client key
 def validate_key(request):
     try:
@@ -66,73 +1017,1302 @@ def validate_key(request):
         logging.error(f"Error validating client key: {e}")
         return False
 
-# Caching results of the search for 5 minutes
-cache = TTLCache(maxsize=100, ttl=300)
+# Search results are shared by all workers through the state database.
+# Entries are fresh for cache_ttl seconds, then served stale while being refreshed
+# in the background, until cache_stale_ttl; the least recently used are evicted
+# beyond cache_max_entries.
+cache_ttl = 300
+cache_stale_ttl = 24 * 3600
+cache_max_entries = 10000
+refresh_executor = ThreadPoolExecutor(max_workers=2)
+refreshing = set()
+refreshing_lock = threading.Lock()
+cache_puts = 0
 
-# Search wallpapers using PeakPx API
-def search_wallpapers(query):
-    if query in cache:
-        return cache[query], True
+# JSON encoded the way jsonify does it, so cached and fresh bodies are identical
+def encode_json(data):
+    return json.dumps(data, separators=(',', ':'), sort_keys=True)
+
+# The /search_wallpapers body for a result, with its content hash as ETag
+def encode_search_response(image_urls):
+    body = (encode_json([{'Image': url} for url in image_urls]) + '\n').encode('utf-8')
+    return body, hashlib.blake2b(body, digest_size=16).hexdigest()
+
+# Cached (image_urls JSON, body, etag, fetched_at), or None when missing or too old to serve
+def cache_lookup(query):
+    db = get_db()
+    row = db.execute('SELECT image_urls, body, etag, fetched_at, accessed_at FROM search_cache WHERE query = ?',
+                     (query,)).fetchone()
+    if row is None:
+        return None
+    now = time.time()
+    if now - row[3] >= cache_stale_ttl:
+        return None
+    # Recency only matters for eviction, so avoid a write on every hit
+    if now - row[4] > 60:
+        db.execute('UPDATE search_cache SET accessed_at = ? WHERE query = ?', (now, query))
+    return row[:4]
+
+# Cached image URLs and their age, or None when missing or too old to serve
+def cache_get(query):
+    row = cache_lookup(query)
+    if row is None:
+        return None
+    return json.loads(row[0]), time.time() - row[3]
+
+# Cached image URLs and age of every query that has a servable entry, in one lookup per 500 queries
+def cache_get_many(queries):
+    db = get_db()
+    now = time.time()
+    entries = {}
+    for start in range(0, len(queries), 500):
+        chunk = queries[start:start + 500]
+        placeholders = ','.join('?' * len(chunk))
+        touched = []
+        for query, image_urls, fetched_at, accessed_at in db.execute(
+                f'SELECT query, image_urls, fetched_at, accessed_at FROM search_cache WHERE query IN ({placeholders})', chunk):
+            if now - fetched_at >= cache_stale_ttl:
+                continue
+            entries[query] = json.loads(image_urls), now - fetched_at
+            if now - accessed_at > 60:
+                touched.append(query)
+        if touched:
+            db.execute(f'UPDATE search_cache SET accessed_at = ? WHERE query IN ({",".join("?" * len(touched))})',
+                       [now] + touched)
+    return entries
+
+def cache_put(query, image_urls):
+    global cache_puts
+    now = time.time()
+    body, etag = encode_search_response(image_urls)
+    db = get_db()
+    db.execute('INSERT OR REPLACE INTO search_cache (query, image_urls, body, etag, fetched_at, accessed_at) '
+               'VALUES (?, ?, ?, ?, ?, ?)', (query, json.dumps(image_urls), body, etag, now, now))
+    cache_puts += 1
+    if cache_puts % 100 == 0:
+        evict_cache()
+
+def evict_cache():
+    db = get_db()
+    excess = db.execute('SELECT COUNT(*) FROM search_cache').fetchone()[0] - cache_max_entries
+    if excess > 0:
+        db.execute('DELETE FROM search_cache WHERE query IN '
+                   '(SELECT query FROM search_cache ORDER BY accessed_at LIMIT ?)', (excess,))
+
+# Cache and flight key of an upstream result page; later pages are cached
+# alongside the first (normalized queries never contain a newline)
+def page_key(query, page=1):
+    return query if page == 1 else f'{query}\n{page}'
 
+# Cache non-empty results and return the flight status for them
+def store_search_result(query, image_urls):
+    if image_urls:
+        cache_put(query, image_urls)
+        return 'found'
+    return 'empty'
+
+# Fetch from PeakPx and store non-empty results in the cache
+def fetch_from_upstream(query, page=1):
+    increment_counter('search_upstream_calls')
+    status = 'error'
     try:
-        wallpapers = px.search_wallpapers(query=query)
-        if wallpapers:
-            image_urls = [wallpaper['url'] for wallpaper in wallpapers]
-            cache[query] = image_urls
-            return image_urls, True
-        else:
-            return [], False
+        with timed('peakpx_request_duration_seconds'):
+            wallpapers = px.search_wallpapers(query=query, page=page)
+        image_urls = [wallpaper['url'] for wallpaper in wallpapers]
+        status = store_search_result(page_key(query, page), image_urls)
+        return image_urls, bool(image_urls)
     except Exception as e:
+        increment_counter('peakpx_errors')
         logging.error(f"Error searching wallpapers: {e}")
         return [], False
+    finally:
+        finish_flight(page_key(query, page), status)
+
+# Single-flight: at most one upstream fetch per query is in flight, within a
+# worker (threads wait on the leader's Flight) and across workers (one worker
+# holds a lease row in search_flights and the others poll for its outcome).
+flight_timeout = 30
+flight_poll_interval = 0.05
+flights = {}
+flights_lock = threading.Lock()
+
+class Flight:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = ([], False)
+        self.error = None
+
+def flight_owner():
+    return f'{os.getpid()}:{threading.get_ident()}'
+
+# Callers that acquire and finish a flight on different threads pass their own owner
+def acquire_flight(query, owner=None):
+    try:
+        now = time.time()
+        cursor = get_db().execute(
+            'INSERT INTO search_flights (query, owner, expires_at, status) VALUES (?, ?, ?, NULL) '
+            'ON CONFLICT (query) DO UPDATE SET owner = excluded.owner, expires_at = excluded.expires_at, status = NULL '
+            'WHERE status IS NOT NULL OR expires_at < ?', (query, owner or flight_owner(), now + flight_timeout, now))
+        return cursor.rowcount == 1
+    except Exception as e:
+        logging.error(f"Error acquiring search flight: {e}")
+        return True
+
+def finish_flight(query, status, owner=None):
+    try:
+        get_db().execute('UPDATE search_flights SET status = ?, expires_at = ? WHERE query = ? AND owner = ?',
+                         (status, time.time(), query, owner or flight_owner()))
+    except Exception as e:
+        logging.error(f"Error finishing search flight: {e}")
+
+# Marker returned by poll_flight while another worker's fetch is still running
+flight_pending = object()
+
+# Status a flight finished with, flight_pending while it runs, or None if there
+# is no flight or its lease ran out
+def flight_status(key):
+    row = get_db().execute('SELECT status, expires_at FROM search_flights WHERE query = ?', (key,)).fetchone()
+    if row is None:
+        return None
+    status, expires_at = row
+    if status is not None:
+        return status
+    if expires_at < time.time():
+        return None
+    return flight_pending
+
+# Outcome of another worker's fetch, flight_pending, or None if its lease ran out
+def poll_flight(query):
+    status = flight_status(query)
+    if status is None or status is flight_pending:
+        return status
+    if status == 'found':
+        entry = cache_get(query)
+        return (entry[0], True) if entry else None
+    return [], False
+
+def wait_for_flight(query):
+    while True:
+        time.sleep(flight_poll_interval)
+        result = poll_flight(query)
+        if result is not flight_pending:
+            return result
+
+def fetch_across_workers(query, page=1):
+    key = page_key(query, page)
+    while True:
+        if acquire_flight(key):
+            return fetch_from_upstream(query, page)
+        result = wait_for_flight(key)
+        if result is not None:
+            increment_counter('search_coalesced_remote')
+            return result
+
+def fetch_wallpapers(query, page=1):
+    key = page_key(query, page)
+    with flights_lock:
+        flight = flights.get(key)
+        leader = flight is None
+        if leader:
+            flight = flights[key] = Flight()
+    if not leader:
+        increment_counter('search_coalesced_local')
+        flight.done.wait()
+        return flight.result
+    try:
+        flight.result = fetch_across_workers(query, page)
+    finally:
+        with flights_lock:
+            del flights[key]
+        flight.done.set()
+    return flight.result
+
+def refresh_wallpapers(query, page=1):
+    try:
+        fetch_wallpapers(query, page)
+    finally:
+        with refreshing_lock:
+            refreshing.discard(page_key(query, page))
+
+# Refresh a stale entry once per worker, off the request thread
+def schedule_refresh(query, page=1):
+    key = page_key(query, page)
+    with refreshing_lock:
+        if key in refreshing:
+            return
+        refreshing.add(key)
+    refresh_executor.submit(refresh_wallpapers, query, page)
+
+# Search wallpapers using PeakPx API
+@timed('function_duration_seconds', function='search_wallpapers')
+def search_wallpapers(query, page=1):
+    try:
+        entry = cache_get(page_key(query, page))
+    except Exception as e:
+        logging.error(f"Error reading search cache: {e}")
+        entry = None
+    if entry is not None:
+        image_urls, age = entry
+        if age >= cache_ttl:
+            schedule_refresh(query, page)
+        return image_urls, True
+    return fetch_wallpapers(query, page)
+
+# Pre-encoded (body, etag, age) of a cached search, or None on a miss
+def cached_search_response(query):
+    try:
+        row = cache_lookup(query)
+    except Exception as e:
+        logging.error(f"Error reading search cache: {e}")
+        return None
+    if row is None:
+        increment_counter('search_cache_misses')
+        return None
+    increment_counter('search_cache_hits')
+    age = time.time() - row[3]
+    if age >= cache_ttl:
+        schedule_refresh(query)
+    return row[1], row[2], age
+
+# Paginated search: results are the concatenated upstream pages, fetched
+# lazily and cached per page. A cursor "page:index" points into one upstream
+# page; page=N skips (N - 1) * limit results from the start, up to
+# search_max_skip results, deeper pages are reached by following cursors. One
+# request reads at most search_request_pages upstream pages, returning fewer
+# results than the limit (with a cursor to continue) when they run out.
+search_default_limit = 20
+search_max_limit = 100
+search_max_upstream_pages = 50
+search_max_skip = 200
+search_request_pages = 10
+
+# (upstream page, index, results to skip, limit), or None when no pagination was asked for
+def parse_search_pagination(args):
+    cursor, page, limit = args.get('cursor'), args.get('page'), args.get('limit')
+    if cursor is None and page is None and limit is None:
+        return None
+    if limit is None:
+        limit = search_default_limit
+    elif not limit.isdigit() or not 0 < int(limit) <= search_max_limit:
+        raise ValueError(f"Invalid limit, expected an integer from 1 to {search_max_limit}")
+    limit = int(limit)
+    if cursor is not None:
+        if page is not None:
+            raise ValueError("Use either page or cursor, not both")
+        upstream_page, _, index = cursor.partition(':')
+        if not upstream_page.isdigit() or not index.isdigit() or int(upstream_page) == 0 or int(index) > search_max_skip:
+            raise ValueError("Invalid cursor")
+        return int(upstream_page), int(index), 0, limit
+    if page is not None and (not page.isdigit() or int(page) == 0):
+        raise ValueError("Invalid page, expected a positive integer")
+    if (int(page or 1) - 1) * limit > search_max_skip:
+        raise ValueError(f"Page too deep, follow next_cursor past the first {search_max_skip} results")
+    return 1, 0, (int(page or 1) - 1) * limit, limit
+
+# Advance over one upstream page: the results taken from it and the position after them
+def take_from_page(image_urls, page, index, skip, wanted):
+    start = index + skip
+    taken = image_urls[start:start + wanted]
+    index = start + len(taken)
+    if index >= len(image_urls):
+        return taken, page + 1, 0, max(start - len(image_urls), 0)
+    return taken, page, index, 0
+
+# Up to limit image URLs from the position, and the cursor after them (None at the end)
+def search_wallpapers_page(query, page, index, skip, limit):
+    images = []
+    for _ in range(search_request_pages):
+        if len(images) >= limit:
+            break
+        if page > search_max_upstream_pages:
+            return images, None
+        image_urls, success = search_wallpapers(query, page)
+        if not success:
+            return images, None
+        taken, page, index, skip = take_from_page(image_urls, page, index, skip, limit - len(images))
+        images.extend(taken)
+    # A skip left over points that far into the next page
+    return images, f'{page}:{index + skip}'
+
+def encode_search_page(image_urls, next_cursor):
+    body = (encode_json({'images': [{'Image': url} for url in image_urls], 'next_cursor': next_cursor}) + '\n').encode('utf-8')
+    return body, hashlib.blake2b(body, digest_size=16).hexdigest()
+
+# Image proxy: upstream images are downloaded once into image_cache_dir, named
+# by the hash of their content, and served from disk with Range and conditional
+# request support (gunicorn sends them with sendfile). The images table maps
+# (source URL, width) to a file, width 0 being the original; thumbnails are
+# resized once with Pillow. The least recently used files are evicted beyond
+# image_cache_max_bytes. Proxy URLs are signed, so only images found by a
+# search can be fetched through the endpoint.
+image_cache_dir = 'image_cache'
+image_cache_max_bytes = int(os.environ.get('IMAGE_CACHE_MAX_MB', '1024')) * 2 ** 20
+image_max_bytes = 20 * 2 ** 20
+image_fetch_timeout = 15
+image_max_age = 30 * 86400
+image_widths = (320, 640, 1280)
+image_puts = 0
+image_signing_key = None
+
+def sign_image_url(url):
+    global image_signing_key
+    if image_signing_key is None:
+        image_signing_key = hashlib.blake2b(b'image-proxy', key=load_client_id_key()).digest()
+    return hashlib.blake2b(url.encode('utf-8'), key=image_signing_key, digest_size=16).hexdigest()
+
+# URL of an image (or its thumbnail) through the proxy on this server
+def proxied_image_url(base_url, url, width=0):
+    params = {'url': url, 'sig': sign_image_url(url)}
+    if width:
+        params['width'] = width
+    return f'{base_url}image?{urlencode(params)}'
+
+# Thumbnail width for proxied search results (0 for the original), or None without proxy=1
+def parse_image_proxy(args):
+    if args.get('proxy') != '1':
+        return None
+    return parse_image_width(args.get('width'))
+
+def parse_image_width(width):
+    if width is None:
+        return 0
+    if not width.isdigit() or int(width) not in image_widths:
+        raise ValueError(f"Invalid width, expected one of {', '.join(map(str, image_widths))}")
+    return int(width)
+
+def image_path(digest):
+    return os.path.join(image_cache_dir, digest[:2], digest)
+
+def hash_file(path):
+    hasher = hashlib.blake2b(digest_size=16)
+    with open(path, 'rb') as file:
+        while chunk := file.read(65536):
+            hasher.update(chunk)
+    return hasher.hexdigest()
+
+# Cached (digest, content type) of an image variant, or None
+def image_lookup(source, width):
+    db = get_db()
+    row = db.execute('SELECT digest, content_type, accessed_at FROM images WHERE source = ? AND width = ?',
+                     (source, width)).fetchone()
+    if row is None or not os.path.exists(image_path(row[0])):
+        return None
+    now = time.time()
+    if now - row[2] > 60:
+        db.execute('UPDATE images SET accessed_at = ? WHERE source = ? AND width = ?', (now, source, width))
+    return row[0], row[1]
+
+# Move a finished temporary file to its content-addressed path and record it
+def image_put(source, width, tmp_path, digest, content_type):
+    global image_puts
+    path = image_path(digest)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    os.replace(tmp_path, path)
+    get_db().execute('INSERT OR REPLACE INTO images (source, width, digest, content_type, size, accessed_at) '
+                     'VALUES (?, ?, ?, ?, ?, ?)', (source, width, digest, content_type, os.path.getsize(path), time.time()))
+    image_puts += 1
+    if image_puts % 50 == 0:
+        evict_images()
+    return digest, content_type
+
+# Remove least recently used variants down to 90% of the limit, and files no variant refers to
+def evict_images():
+    db = get_db()
+    total = db.execute('SELECT COALESCE(SUM(size), 0) FROM images').fetchone()[0]
+    if total <= image_cache_max_bytes:
+        return
+    for source, width, digest, size in db.execute(
+            'SELECT source, width, digest, size FROM images ORDER BY accessed_at').fetchall():
+        if total <= image_cache_max_bytes * 0.9:
+            break
+        db.execute('DELETE FROM images WHERE source = ? AND width = ?', (source, width))
+        total -= size
+        if db.execute('SELECT 1 FROM images WHERE digest = ?', (digest,)).fetchone() is None:
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(image_path(digest))
+
+def temporary_image_path():
+    os.makedirs(image_cache_dir, exist_ok=True)
+    return os.path.join(image_cache_dir, f'{uuid.uuid4().hex}.tmp')
+
+# Download an image to a temporary file, hashing it on the way
+def download_image(url):
+    tmp_path = temporary_image_path()
+    hasher = hashlib.blake2b(digest_size=16)
+    size = 0
+    try:
+        with requests.get(url, stream=True, timeout=image_fetch_timeout) as response:
+            response.raise_for_status()
+            content_type = response.headers.get('Content-Type', '').split(';')[0].strip()
+            if not content_type.startswith('image/'):
+                raise ValueError(f"Unexpected content type {content_type!r}")
+            with open(tmp_path, 'wb') as file:
+                for chunk in response.iter_content(65536):
+                    size += len(chunk)
+                    if size > image_max_bytes:
+                        raise ValueError(f"Image larger than {image_max_bytes} bytes")
+                    hasher.update(chunk)
+                    file.write(chunk)
+    except BaseException:
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(tmp_path)
+        raise
+    return tmp_path, hasher.hexdigest(), content_type
+
+# Pillow is optional, without it thumbnail requests are served the original image
+def pillow_available():
+    return importlib.util.find_spec('PIL') is not None
+
+# Downscale an image to the width as a JPEG temporary file
+def make_thumbnail(path, width):
+    tmp_path = temporary_image_path()
+    try:
+        from PIL import Image
+        with Image.open(path) as image:
+            # Let the JPEG decoder skip detail the thumbnail does not need
+            image.draft('RGB', (width, max(width * image.height // max(image.width, 1), 1)))
+            image.thumbnail((width, image.height))
+            if image.mode not in ('RGB', 'L'):
+                image = image.convert('RGB')
+            image.save(tmp_path, 'JPEG', quality=85, optimize=True)
+    except BaseException:
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(tmp_path)
+        raise
+    return tmp_path, hash_file(tmp_path)
+
+def make_image(source, width):
+    if width:
+        original = get_image(source)
+        if not pillow_available():
+            return original
+        tmp_path, digest = make_thumbnail(image_path(original[0]), width)
+        return image_put(source, width, tmp_path, digest, 'image/jpeg')
+    tmp_path, digest, content_type = download_image(source)
+    return image_put(source, 0, tmp_path, digest, content_type)
+
+# Image variants are single-flight like searches, under lease keys that cannot
+# collide with a normalized query
+def image_flight_key(source, width):
+    return f'\nimage\n{width}\n{source}'
+
+def make_image_across_workers(source, width):
+    key = image_flight_key(source, width)
+    while True:
+        if acquire_flight(key):
+            status = 'error'
+            try:
+                result = image_lookup(source, width) or make_image(source, width)
+                status = 'found'
+                return result
+            finally:
+                finish_flight(key, status)
+        increment_counter('image_coalesced_remote')
+        status = flight_pending
+        while status is flight_pending:
+            time.sleep(flight_poll_interval)
+            status = flight_status(key)
+        cached = image_lookup(source, width)
+        if cached is not None:
+            return cached
+        if status == 'error':
+            raise RuntimeError("Image fetch failed in another worker")
+
+# (digest, content type) of an image variant, fetched or generated on first use
+@timed('function_duration_seconds', function='get_image')
+def get_image(source, width=0):
+    cached = image_lookup(source, width)
+    if cached is not None:
+        return cached
+    key = image_flight_key(source, width)
+    with flights_lock:
+        flight = flights.get(key)
+        leader = flight is None
+        if leader:
+            flight = flights[key] = Flight()
+    if not leader:
+        increment_counter('image_coalesced_local')
+        flight.done.wait()
+        if flight.error is not None:
+            raise flight.error
+        return flight.result
+    try:
+        flight.result = make_image_across_workers(source, width)
+    except Exception as e:
+        flight.error = e
+        raise
+    finally:
+        with flights_lock:
+            del flights[key]
+        flight.done.set()
+    return flight.result
+
+# Batch search: every distinct query is checked for profanity in one pass, cache
+# hits are read in one lookup and misses fetched by a pool shared by the
+# worker's batch requests, so one batch cannot flood PeakPx. Queries still
+# running after search_batch_timeout are reported as timeouts and keep
+# filling the cache in the background.
+search_batch_max_queries = 50
+search_batch_concurrency = 8
+search_batch_timeout = 20
+batch_executor = ThreadPoolExecutor(max_workers=search_batch_concurrency)
+
+# {query: (image_urls, success)} of the found queries and {query: error} of the failed ones
+def search_batch(queries):
+    try:
+        cached = cache_get_many(queries)
+    except Exception as e:
+        logging.error(f"Error reading search cache: {e}")
+        cached = {}
+    increment_counter('search_cache_hits', len(cached))
+    results, errors = {}, {}
+    for query, (image_urls, age) in cached.items():
+        if age >= cache_ttl:
+            schedule_refresh(query)
+        results[query] = image_urls, True
+    misses = [query for query in queries if query not in cached]
+    if misses:
+        increment_counter('search_cache_misses', len(misses))
+        futures = {batch_executor.submit(fetch_wallpapers, query): query for query in misses}
+        done, pending = wait(futures, timeout=search_batch_timeout)
+        for future in done:
+            try:
+                results[futures[future]] = future.result()
+            except Exception as e:
+                logging.error(f"Error searching wallpapers: {e}")
+                errors[futures[future]] = 'error'
+        for future in pending:
+            errors[futures[future]] = 'timeout'
+        # An empty result is "not found" unless the flight recorded an upstream error
+        failed = [query for query, (_, success) in results.items() if not success]
+        if failed:
+            for query, status in get_db().execute(
+                    f'SELECT query, status FROM search_flights WHERE query IN ({",".join("?" * len(failed))})', failed):
+                if status == 'error':
+                    errors[query] = 'error'
+    return results, errors
+
+# Response for an encoded JSON body, or 304 when the client already has it
+def json_bytes_response(body, etag, max_age):
+    if request.if_none_match.contains_weak(etag):
+        response = Response(status=304)
+    else:
+        response = Response(body, mimetype='application/json')
+    response.set_etag(etag)
+    response.cache_control.public = True
+    response.cache_control.max_age = max(int(max_age), 0)
+    return response
 
 # Train model for recommendation system
+@timed('function_duration_seconds', function='train_model')
 def train_model(queries):
+    from sklearn.cluster import KMeans
+    from sklearn.feature_extraction.text import TfidfVectorizer
     vectorizer = TfidfVectorizer(stop_words='english')
     X = vectorizer.fit_transform(queries)
-    kmeans = KMeans(n_clusters=5, random_state=0)
+    kmeans = KMeans(n_clusters=min(5, len(queries)), random_state=0)
     kmeans.fit(X)
     return vectorizer, kmeans
 
-# Partial query recommendation function
-def partial_query_recommendation(partial_query, queries, query_counter, vectorizer, model, top_n=5, min_frequency=5):
-    try:
-        partial_vec = vectorizer.transform([partial_query.lower()])
-        similarities = cosine_similarity(partial_vec, vectorizer.transform(queries)).flatten()
-        sorted_indices = np.argsort(similarities)[::-1]
-
-        unique_recommendations = []
-        seen = set()
-        for idx in sorted_indices:
-            if queries[idx].startswith(partial_query.lower()) and query_counter[queries[idx]] >= min_frequency and queries[idx] not in seen:
-                unique_recommendations.append((queries[idx], query_counter[queries[idx]]))
-                seen.add(queries[idx])
-            if len(unique_recommendations) == top_n:
+# Trained recommendation artifacts, written by train_models.py
+models_dir = 'models'
+
+class ModelBundle:
+    def __init__(self, version, vectorizer, kmeans, queries, counts, matrix, labels):
+        self.version = version
+        self.vectorizer = vectorizer
+        self.kmeans = kmeans
+        self.queries = queries
+        self.counts = counts
+        self.matrix = matrix
+        self.labels = labels
+
+# Load a model version, memory-mapping the arrays so workers share their pages
+def load_model_bundle(version):
+    import joblib
+    from scipy.sparse import csr_matrix
+    path = os.path.join(models_dir, version)
+    with open(os.path.join(path, 'meta.json')) as file:
+        meta = json.load(file)
+    with open(os.path.join(path, 'queries.json')) as file:
+        queries = json.load(file)
+    arrays = {name: np.load(os.path.join(path, f'{name}.npy'), mmap_mode='r')
+              for name in ('tfidf_data', 'tfidf_indices', 'tfidf_indptr', 'counts', 'labels')}
+    matrix = csr_matrix((arrays['tfidf_data'], arrays['tfidf_indices'], arrays['tfidf_indptr']),
+                        shape=tuple(meta['shape']), copy=False)
+    return ModelBundle(version, joblib.load(os.path.join(path, 'vectorizer.joblib')),
+                       joblib.load(os.path.join(path, 'kmeans.joblib')),
+                       queries, arrays['counts'], matrix, arrays['labels'])
+
+def current_model_version():
+    try:
+        with open(os.path.join(models_dir, 'CURRENT')) as file:
+            return file.read().strip() or None
+    except FileNotFoundError:
+        return None
+
+model_bundle = None
+model_reload_lock = threading.Lock()
+model_checked_at = 0.0
+
+# Swap to the version named in models/CURRENT; the old bundle keeps serving until the new one is loaded
+def reload_models():
+    global model_bundle
+    if not model_reload_lock.acquire(blocking=False):
+        return
+    try:
+        version = current_model_version()
+        if version and (model_bundle is None or model_bundle.version != version):
+            model_bundle = load_model_bundle(version)
+            logging.info(f"Loaded recommendation models {version}")
+    except Exception as e:
+        logging.error(f"Error loading recommendation models: {e}")
+    finally:
+        model_reload_lock.release()
+
+# Current model bundle, checking for a new version in the background at most every few seconds;
+# unless the master preloaded them, a worker loads the models on first use
+def get_model_bundle(check_interval=5.0):
+    global model_checked_at
+    if model_bundle is None and not model_checked_at:
+        model_checked_at = time.monotonic()
+        reload_models()
+        return model_bundle
+    if time.monotonic() - model_checked_at >= check_interval:
+        model_checked_at = time.monotonic()
+        version = current_model_version()
+        if version and (model_bundle is None or model_bundle.version != version):
+            threading.Thread(target=reload_models, daemon=True).start()
+    return model_bundle
+
+# Queries similar to the partial query according to the trained TF-IDF model
+def similar_query_recommendation(partial_query, top_n=5, min_frequency=5):
+    bundle = get_model_bundle()
+    if bundle is None or not bundle.queries:
+        return []
+    partial_vec = bundle.vectorizer.transform([canonicalize_query(partial_query)])
+    if not partial_vec.nnz:
+        return []
+    # Rows are L2-normalized, so the dot product is the cosine similarity
+    similarities = (bundle.matrix @ partial_vec.T).toarray().ravel()
+    recommendations = []
+    for i in np.argsort(similarities)[::-1]:
+        if similarities[i] <= 0 or len(recommendations) == top_n:
+            break
+        query = bundle.queries[i]
+        count = prefix_index.count(query) or int(bundle.counts[i])
+        if count >= min_frequency:
+            recommendations.append((query, count))
+    recommendations.sort(key=lambda x: (-x[1], x[0]))
+    return recommendations
+
+# Frequency-weighted prefix index over the distinct logged queries, kept in flat
+# arrays instead of a trie: the queries in sorted order, packed into one UTF-8
+# buffer with their offsets, and their counts. The queries with a prefix are a
+# contiguous range found by binary search; prefixes covering more than
+# prefix_scan_limit queries have their top-k precomputed, smaller ranges are
+# ranked on the fly. Changed counts go to a small sorted delta that searches
+# merge in, until prefix_delta_limit queries are folded into a new snapshot.
+# Snapshots and deltas are replaced, never modified, so searches need no lock.
+prefix_scan_limit = 256
+prefix_delta_limit = 4096
+
+class PrefixSnapshot:
+    def __init__(self, blob, offsets, counts, top_k):
+        self.blob = blob
+        # An array rather than numpy, since binary search indexes it one element at a time
+        self.offsets = array('q')
+        self.offsets.frombytes(offsets.astype(np.int64).tobytes())
+        self.counts = counts
+        self.size = len(counts)
+        self.top = self._precompute(top_k)
+
+    @classmethod
+    def build(cls, keys, counts, top_k):
+        offsets = np.zeros(len(keys) + 1, dtype=np.int64)
+        np.cumsum([len(key) for key in keys], out=offsets[1:])
+        return cls(b''.join(keys), offsets, np.asarray(counts, dtype=np.int64), top_k)
+
+    def key(self, i):
+        return self.blob[self.offsets[i]:self.offsets[i + 1]]
+
+    # First index whose key is not below the given one
+    def lower(self, key, lo=0, hi=None):
+        hi = self.size if hi is None else hi
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.key(mid) < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    # Range of the keys starting with the prefix; 0xff never occurs in UTF-8
+    def range(self, prefix, lo=0, hi=None):
+        lo = self.lower(prefix, lo, hi)
+        return lo, self.lower(prefix + b'\xff', lo, hi)
+
+    # Top k (count, query) of a range, most frequent first, ties alphabetically
+    def rank(self, lo, hi, k):
+        counts = self.counts[lo:hi]
+        if hi - lo > k:
+            kth = np.partition(counts, hi - lo - k)[hi - lo - k]
+            candidates = np.flatnonzero(counts >= kth)
+        else:
+            candidates = np.arange(hi - lo)
+        order = candidates[np.lexsort((candidates, -counts[candidates]))[:k]]
+        return tuple((int(counts[i]), self.key(lo + i).decode('utf-8')) for i in order.tolist())
+
+    def _precompute(self, top_k):
+        top = {}
+        stack = [(b'', 0, self.size)]
+        while stack:
+            prefix, lo, hi = stack.pop()
+            if hi - lo <= prefix_scan_limit:
+                continue
+            top[prefix] = self.rank(lo, hi, top_k)
+            # One child range per next character; the prefix itself sorts first
+            i = lo + 1 if len(self.key(lo)) == len(prefix) else lo
+            while i < hi:
+                key = self.key(i)
+                # Extend by one whole UTF-8 character
+                length = len(prefix) + 1
+                while length < len(key) and key[length] & 0xc0 == 0x80:
+                    length += 1
+                _, end = self.range(key[:length], i, hi)
+                stack.append((key[:length], i, end))
+                i = end
+        return top
+
+class PrefixIndex:
+    def __init__(self, top_k=5):
+        self.top_k = top_k
+        # The snapshot, the delta's sorted queries and its {query: count}, swapped as one
+        self.state = (PrefixSnapshot.build([], [], top_k), (), {})
+
+    def count(self, query):
+        snapshot, _, delta = self.state
+        count = delta.get(query)
+        if count is not None:
+            return count
+        key = query.encode('utf-8')
+        i = snapshot.lower(key)
+        return int(snapshot.counts[i]) if i < snapshot.size and snapshot.key(i) == key else 0
+
+    # Apply (query, count) pairs; counts only ever grow. Callers serialize updates.
+    def update(self, items):
+        snapshot, _, delta = self.state
+        highest = {}
+        for query, count in items:
+            if count > highest.get(query, 0):
+                highest[query] = count
+        if len(highest) > prefix_delta_limit:
+            # A bulk load goes straight into a new snapshot
+            for query, count in delta.items():
+                highest[query] = max(highest.get(query, 0), count)
+            self.state = (self._merge(snapshot, highest), (), {})
+            return
+        changes = {query: count for query, count in highest.items() if count > self.count(query)}
+        if not changes:
+            return
+        counts = {**delta, **changes}
+        if len(counts) > prefix_delta_limit:
+            self.state = (self._merge(snapshot, counts), (), {})
+        else:
+            self.state = (snapshot, tuple(sorted(counts)), counts)
+
+    # A new snapshot with the changed counts folded in
+    def _merge(self, snapshot, changes):
+        if len(changes) * 32 >= snapshot.size:
+            merged = {query.encode('utf-8'): count for query, count in changes.items()}
+            for i, count in enumerate(snapshot.counts.tolist()):
+                key = snapshot.key(i)
+                if count > merged.get(key, 0):
+                    merged[key] = count
+            keys = sorted(merged)
+            return PrefixSnapshot.build(keys, [merged[key] for key in keys], self.top_k)
+        # Few changes: update counts in place of a copy and splice new queries into the buffer
+        counts = snapshot.counts.copy()
+        added = []
+        for query, count in changes.items():
+            key = query.encode('utf-8')
+            i = snapshot.lower(key)
+            if i < snapshot.size and snapshot.key(i) == key:
+                counts[i] = max(counts[i], count)
+            else:
+                added.append((key, count))
+        offsets = np.frombuffer(snapshot.offsets, dtype=np.int64)
+        if not added:
+            return PrefixSnapshot(snapshot.blob, offsets, counts, self.top_k)
+        added.sort()
+        positions = [snapshot.lower(key) for key, _ in added]
+        pieces, previous = [], 0
+        for position, (key, _) in zip(positions, added):
+            pieces.append(snapshot.blob[offsets[previous]:offsets[position]])
+            pieces.append(key)
+            previous = position
+        pieces.append(snapshot.blob[offsets[previous]:])
+        lengths = np.insert(np.diff(offsets), positions, [len(key) for key, _ in added])
+        new_offsets = np.zeros(len(lengths) + 1, dtype=np.int64)
+        np.cumsum(lengths, out=new_offsets[1:])
+        counts = np.insert(counts, positions, [count for _, count in added])
+        return PrefixSnapshot(b''.join(pieces), new_offsets, counts, self.top_k)
+
+    def search(self, prefix, top_n=5, min_frequency=5):
+        snapshot, delta_keys, delta_counts = self.state
+        key = prefix.encode('utf-8')
+        top = snapshot.top.get(key)
+        if top is None:
+            top = snapshot.rank(*snapshot.range(key), self.top_k)
+        # Counts only grow, so a query outside the snapshot's top-k can only get in through the delta
+        candidates = {query: count for count, query in top}
+        i = bisect.bisect_left(delta_keys, prefix)
+        while i < len(delta_keys) and delta_keys[i].startswith(prefix):
+            candidates[delta_keys[i]] = delta_counts[delta_keys[i]]
+            i += 1
+        ranked = sorted(candidates.items(), key=lambda item: (-item[1], item[0]))[:min(top_n, self.top_k)]
+        return [(query, count) for query, count in ranked if count >= min_frequency]
+
+# Typo-tolerant lookup over the distinct logged queries: each query is indexed
+# under the character trigrams of its start-padded form, so the grams of a
+# prefix are a subset of the query's. A query whose prefix is within k edits of
+# the input misses at most 3k of the input's grams, so it is in one of the
+# 3k + 1 rarest postings lists. Those, and more up to fuzzy_scan_limit entries,
+# are counted with numpy; the queries with the most shared grams are checked
+# with a prefix edit distance and the matches ranked by distance, then frequency.
+fuzzy_min_length = 4
+fuzzy_scan_limit = 20000
+fuzzy_verify_limit = 50
+
+def prefix_edit_distance(text, candidate, limit):
+    column = list(range(len(text) + 1))
+    best = column[-1]
+    for char in candidate[:len(text) + limit]:
+        previous, column[0] = column[0], column[0] + 1
+        for i, text_char in enumerate(text, 1):
+            current = min(column[i] + 1, column[i - 1] + 1, previous + (text_char != char))
+            previous, column[i] = column[i], current
+        best = min(best, column[-1])
+        if min(column) > limit:
+            break
+    return best
+
+class FuzzyIndex:
+    def __init__(self):
+        self.queries = []
+        self.ids = {}
+        self.postings = {}
+        # Grown by replacement, never resized in place, so readers can index it while it is updated
+        self.counts = np.zeros(1024, dtype=np.int64)
+
+    @staticmethod
+    def grams(text):
+        padded = '\0\0' + text
+        return {padded[i:i + 3] for i in range(len(text))}
+
+    def update(self, query, count):
+        query_id = self.ids.get(query)
+        if query_id is None:
+            query_id = len(self.queries)
+            if query_id == len(self.counts):
+                self.counts = np.concatenate([self.counts, np.zeros_like(self.counts)])
+            self.queries.append(query)
+            self.ids[query] = query_id
+            for gram in self.grams(query):
+                postings = self.postings.get(gram)
+                if postings is None:
+                    postings = self.postings[gram] = array('I')
+                postings.append(query_id)
+        self.counts[query_id] = count
+
+    # (query, count) of queries starting within a few edits of text, closest and most frequent first
+    def search(self, text, top_n=5, min_frequency=5):
+        if len(text) < fuzzy_min_length:
+            return []
+        max_distance = 1 if len(text) < 8 else 2
+        lists = sorted((self.postings.get(gram, ()) for gram in self.grams(text)), key=len)
+        chosen, scanned = [], 0
+        for postings in lists:
+            if len(chosen) > 3 * max_distance and scanned + len(postings) > fuzzy_scan_limit:
                 break
+            # Copied, since a view would keep the sync thread from appending to the array
+            chosen.append(np.array(postings, dtype=np.uint32))
+            scanned += len(postings)
+        ids, hits = np.unique(np.concatenate(chosen), return_counts=True)
+        counts = self.counts[ids]
+        keep = (hits >= max(len(chosen) - 3 * max_distance, 1)) & (counts >= min_frequency)
+        ids, hits, counts = ids[keep], hits[keep], counts[keep]
+        # Most shared grams first, then most frequent, without sorting every candidate
+        scores = (hits.astype(np.int64) << 40) | np.minimum(counts, (1 << 40) - 1)
+        if len(scores) > fuzzy_verify_limit:
+            top = np.argpartition(-scores, fuzzy_verify_limit)[:fuzzy_verify_limit]
+            ids, counts, scores = ids[top], counts[top], scores[top]
+        order = np.argsort(-scores)
+        matches = []
+        for query_id, count in zip(ids[order].tolist(), counts[order].tolist()):
+            query = self.queries[query_id]
+            distance = prefix_edit_distance(text, query, max_distance)
+            if distance <= max_distance:
+                matches.append((distance, -count, query))
+                if len(matches) == 2 * top_n:
+                    break
+        matches.sort()
+        return [(query, -negative_count) for _, negative_count, query in matches[:top_n]]
 
-        # Sort by frequency
-        unique_recommendations.sort(key=lambda x: (-x[1], x[0]))
+prefix_index = PrefixIndex()
+fuzzy_index = FuzzyIndex()
+prefix_index_lock = threading.Lock()
+prefix_index_synced_at = 0.0
+prefix_index_checked_at = 0.0
+prefix_sync_overlap = 2.0
 
-        return [recommendation for recommendation, _ in unique_recommendations]
+# Apply query counts changed by any worker since the last sync
+def sync_prefix_index(min_interval=1.0):
+    global prefix_index_synced_at, prefix_index_checked_at
+    if time.monotonic() - prefix_index_checked_at < min_interval:
+        return
+    with prefix_index_lock:
+        prefix_index_checked_at = time.monotonic()
+        # Re-read a short overlap in case the clock was stepped back
+        since = prefix_index_synced_at - prefix_sync_overlap
+        rows = get_db().execute('SELECT query, count, updated_at FROM query_stats WHERE updated_at > ?', (since,)).fetchall()
+        prefix_index.update((query, count) for query, count, _ in rows)
+        for query, count, updated_at in rows:
+            fuzzy_index.update(query, count)
+            prefix_index_synced_at = max(prefix_index_synced_at, updated_at)
+
+# Partial query recommendation function
+@timed('function_duration_seconds', function='partial_query_recommendation')
+def partial_query_recommendation(partial_query, top_n=5, min_frequency=5):
+    try:
+        sync_prefix_index()
+        prefix = canonicalize_query(partial_query)
+        recommendations = prefix_index.search(prefix, top_n, min_frequency)
+        if not recommendations:
+            recommendations = fuzzy_index.search(prefix, top_n, min_frequency)
+        if not recommendations:
+            recommendations = similar_query_recommendation(partial_query, top_n, min_frequency)
+        return [recommendation for recommendation, _ in recommendations]
     except Exception as e:
         logging.error(f"Error in partial_query_recommendation: {e}")
         return []
 
-# Load data from CSV file for logging queries
-def load_data(filename):
-    queries = []
+# Profanity filter: the better_profanity word list compiled once into an
+# Aho-Corasick automaton. Text and words are normalized the same way (case
+# folded, common leetspeak digits and symbols mapped to letters), each word is
+# also added with any one vowel written as '*', and matches only count on
+# whole-word boundaries, like better_profanity. '!' only stands for 'i' between
+# letters or digits; elsewhere it is punctuation and separates words. '@' may
+# be an 'a' or an 'o', so words are added with it in place of any of those.
+# Like better_profanity, a word written across up to max_join words of the
+# text ("f u c k s", "blow jobs") is also matched.
+LEET_TABLE = str.maketrans({'4': 'a', '0': 'o', '3': 'e', '5': 's', '$': 's', '7': 't',
+                            '1': 'i', 'l': 'i', 'v': 'u'})
+INNER_BANG = re.compile(r'(?<=[^\W_])!+(?=[^\W_])')
+WORD_RUN = re.compile(r'(?:[^\W_]|[*\'"@])+')
+
+def normalize_for_profanity(text):
+    text = INNER_BANG.sub(lambda match: 'i' * len(match.group()), text.casefold().translate(LEET_TABLE))
+    return ' '.join(text.split())
+
+# Spellings of a normalized word with '@' for any of its a's and o's
+def at_spellings(word):
+    return {''.join(chars) for chars in itertools.product(*[(char, '@') if char in 'ao' else char for char in word])}
+
+class ProfanityFilter:
+    def __init__(self, words, memo_size=10000):
+        self.goto = [{}]
+        self.fail = [0]
+        self.output = [()]
+        self.max_join = 1
+        for word in words:
+            word = normalize_for_profanity(word)
+            if not word:
+                continue
+            self.max_join = max(self.max_join, sum(not is_word_char(char) for char in word) + 1)
+            for spelling in at_spellings(word):
+                self._add(spelling)
+                for i, char in enumerate(spelling):
+                    if char in 'aeiou':
+                        self._add(spelling[:i] + '*' + spelling[i + 1:])
+        self._build_fail_links()
+        self.memo = LRUCache(maxsize=memo_size)
+        self.memo_lock = threading.Lock()
+
+    def _add(self, pattern):
+        state = 0
+        for char in pattern:
+            next_state = self.goto[state].get(char)
+            if next_state is None:
+                next_state = len(self.goto)
+                self.goto[state][char] = next_state
+                self.goto.append({})
+                self.fail.append(0)
+                self.output.append(())
+            state = next_state
+        self.output[state] += (len(pattern),)
+
+    def _build_fail_links(self):
+        frontier = list(self.goto[0].values())
+        while frontier:
+            next_frontier = []
+            for state in frontier:
+                for char, child in self.goto[state].items():
+                    fallback = self.fail[state]
+                    while fallback and char not in self.goto[fallback]:
+                        fallback = self.fail[fallback]
+                    self.fail[child] = self.goto[fallback].get(char, 0) if state else 0
+                    self.output[child] += self.output[self.fail[child]]
+                    next_frontier.append(child)
+            frontier = next_frontier
+
+    # Start and end positions of every word in text
+    def _scan(self, text):
+        goto, fail, output = self.goto, self.fail, self.output
+        state = 0
+        for end, char in enumerate(text, 1):
+            while state and char not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(char, 0)
+            for length in output[state]:
+                yield end - length, end
+
+    # Start and end positions of the whole-word matches in normalized text,
+    # then of the words written across several words of it
+    def _matches(self, text):
+        for start, end in self._scan(text):
+            if (start == 0 or not is_word_char(text[start - 1])) and (end == len(text) or not is_word_char(text[end])):
+                yield start, end
+        runs = list(WORD_RUN.finditer(text))
+        if len(runs) < 2:
+            return
+        # The word characters with the separators dropped, except newlines,
+        # which separate the texts of a batch; run_of maps each character to its word
+        chars, origins, run_of, starts, ends = [], [], [], set(), set()
+        for i, run in enumerate(runs):
+            if i and '\n' in text[runs[i - 1].end():run.start()]:
+                chars.append('\n')
+                origins.append(run.start() - 1)
+                run_of.append(-1)
+            starts.add(len(chars))
+            chars.extend(run.group())
+            origins.extend(range(run.start(), run.end()))
+            run_of.extend([i] * len(run.group()))
+            ends.add(len(chars))
+        for start, end in self._scan(''.join(chars)):
+            if start in starts and end in ends and 0 < run_of[end - 1] - run_of[start] < self.max_join:
+                yield origins[start], origins[end - 1] + 1
+
+    def contains(self, query):
+        text = normalize_for_profanity(query)
+        with self.memo_lock:
+            verdict = self.memo.get(text)
+        if verdict is None:
+            verdict = next(self._matches(text), None) is not None
+            with self.memo_lock:
+                self.memo[text] = verdict
+        return verdict
+
+    # Verdicts for a list of queries, scanning all unmemoized ones in a single pass
+    def check_batch(self, queries):
+        texts = [normalize_for_profanity(query) for query in queries]
+        with self.memo_lock:
+            verdicts = [self.memo.get(text) for text in texts]
+        pending = [i for i, verdict in enumerate(verdicts) if verdict is None]
+        if pending:
+            # Newlines separate the texts and act as word boundaries
+            offsets, position = [], 0
+            for i in pending:
+                offsets.append(position)
+                position += len(texts[i]) + 1
+                verdicts[i] = False
+            for start, _ in self._matches('\n'.join(texts[i] for i in pending)):
+                verdicts[pending[bisect.bisect_right(offsets, start) - 1]] = True
+            with self.memo_lock:
+                for i in pending:
+                    self.memo[texts[i]] = verdicts[i]
+        return verdicts
+
+def is_word_char(char):
+    return char.isalnum() or char in '*\'"@'
+
+profanity_filter = ProfanityFilter(read_wordlist(get_complete_path_of_file('profanity_wordlist.txt')))
+
+# Function to check if a query is inappropriate
+@timed('function_duration_seconds', function='is_inappropriate')
+def is_inappropriate(query):
+    return profanity_filter.contains(query)
+
+# The queries that are not inappropriate, checked as one batch
+def appropriate_only(queries):
+    return [query for query, inappropriate in zip(queries, profanity_filter.check_batch(queries)) if not inappropriate]
+
+# Latency of every request, by route and status
+@app.before_request
+def start_request_timer():
+    g.request_started = time.perf_counter()
+
+@app.after_request
+def observe_request(response):
+    record_first_request()
+    started = g.pop('request_started', None)
+    if started is not None:
+        observe('http_request_duration_seconds', time.perf_counter() - started, method=request.method,
+                route=request.url_rule.rule if request.url_rule else 'unmatched', status=response.status_code)
+    return response
+
+# Admission control: token buckets per client IP and per API key, with separate
+# budgets (tokens per second, burst) for each route. The buckets live in a
+# memory-mapped file shared by all workers. A bucket is stored as the time it
+# will be full again (GCRA style) and a tag, in the first slot holding its tag
+# among rate_limit_probe slots from the one its hash of (scope, identity,
+# route) picks. A bucket without a slot takes over the one that is soonest
+# full and inherits its state, so colliding clients share a budget rather than
+# refill each other. Set RATE_LIMITING=0 to disable. Per-IP buckets only apply
+# to clients whose address is known (see forwarded_client).
+# Every client currently sends the same server_key, so per-key budgets would cap
+# all traffic to a route together; they only apply with RATE_LIMIT_KEYS=1.
+rate_limiting = os.environ.get('RATE_LIMITING', '1') == '1'
+rate_limit_keys = os.environ.get('RATE_LIMIT_KEYS', '0') == '1'
+rate_limit_file = 'rate_limits.bin'
+rate_limit_slots = 65536
+rate_limit_probe = 8
+rate_limits = {
+    '/search_wallpapers': {'ip': (2, 20), 'key': (200, 400)},
+    '/recommendations': {'ip': (10, 30), 'key': (500, 1000)},
+    '/trending': {'ip': (5, 20), 'key': (500, 1000)},
+    '/view_logs': {'ip': (1, 5), 'key': (20, 40)},
+    '/query_rollups': {'ip': (1, 5), 'key': (20, 40)},
+    '/search_batch': {'ip': (0.5, 5), 'key': (50, 100)},
+    '/image': {'ip': (20, 200), 'key': (1000, 2000)},
+}
+
+class RateLimiter:
+    slot = struct.Struct('dQ')
+
+    def __init__(self, path, slots, cache_size=10000):
+        self.path = path
+        self.slots = slots
+        self.cache_size = cache_size
+        self.offsets = {}
+        self.pid = None
+
+    # Map the file once per process, sizing it on first use
+    def _map(self):
+        if self.pid != os.getpid():
+            fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o600)
+            size = self.slots * self.slot.size
+            if os.fstat(fd).st_size < size:
+                os.ftruncate(fd, size)
+            self.fd = fd
+            self.map = mmap.mmap(fd, size)
+            # flock excludes other workers, the thread lock this worker's own threads
+            self.lock = threading.Lock()
+            self.pid = os.getpid()
+        return self.map
+
+    # Slot offset and tag of a bucket, memoized since hashing dominates the cost
+    def _bucket(self, scope, identity, route):
+        name = (scope, identity, route)
+        bucket = self.offsets.get(name)
+        if bucket is None:
+            if len(self.offsets) >= self.cache_size:
+                self.offsets.clear()
+            digest = hashlib.blake2b(f'{scope}\0{identity}\0{route}'.encode('utf-8'), digest_size=8).digest()
+            # Tag 0 marks a slot never used
+            tag = int.from_bytes(digest, 'little') or 1
+            bucket = self.offsets[name] = (tag % self.slots, tag)
+        return bucket
+
+    # Offset and full-at time of a bucket's slot: the slot holding its tag, or else
+    # the one in its probe window that is soonest full, skipping slots already taken
+    def _find(self, data, home, tag, taken):
+        best = None
+        for probe in range(rate_limit_probe):
+            offset = ((home + probe) % self.slots) * self.slot.size
+            if offset in taken:
+                continue
+            full_at, slot_tag = self.slot.unpack_from(data, offset)
+            if slot_tag == tag:
+                return offset, full_at
+            if best is None or full_at < best[1]:
+                best = offset, full_at
+        return best
+
+    # 0 when the request is admitted (taking a token from each bucket), otherwise
+    # the seconds until every bucket has a token again
+    def admit(self, route, ip_address, key=None, now=None):
+        limits = rate_limits.get(route)
+        if limits is None:
+            return 0
+        buckets = []
+        if ip_address is not None:
+            buckets.append((self._bucket('ip', ip_address, route), limits['ip']))
+        if key is not None:
+            buckets.append((self._bucket('key', key, route), limits['key']))
+        if not buckets:
+            return 0
+        now = time.time() if now is None else now
+        data = self._map()
+        with self.lock:
+            fcntl.flock(self.fd, fcntl.LOCK_EX)
+            try:
+                states, wait = [], 0
+                for (home, tag), (rate, burst) in buckets:
+                    offset, full_at = self._find(data, home, tag, {state[0] for state in states})
+                    tokens = burst - max(full_at - now, 0) * rate
+                    if tokens < 1:
+                        wait = max(wait, (1 - tokens) / rate)
+                    states.append((offset, tag, full_at, max(full_at, now) + 1 / rate))
+                for offset, tag, full_at, admitted_full_at in states:
+                    # A refused request takes no token, but the bucket still claims its slot
+                    self.slot.pack_into(data, offset, full_at if wait else admitted_full_at, tag)
+                return wait
+            finally:
+                fcntl.flock(self.fd, fcntl.LOCK_UN)
+
+rate_limiter = RateLimiter(rate_limit_file, rate_limit_slots)
+
+# Proxies trusted to name the client in X-Forwarded-For, by default the local
+# playit agent. Everything it tunnels arrives from its address, so a request
+# from a trusted proxy that names no client has no known address.
+trusted_proxies = set(filter(None, os.environ.get('TRUSTED_PROXIES', '127.0.0.1,::1,::ffff:127.0.0.1').split(',')))
+
+# The client's address, or None when only trusted proxies are known
+def forwarded_client(remote_addr, forwarded_for):
+    if remote_addr not in trusted_proxies:
+        return remote_addr
+    for address in reversed((forwarded_for or '').split(',')):
+        address = address.strip()
+        if address and address not in trusted_proxies:
+            return address
+    return None
+
+# Seconds to wait before retrying, or 0 when the request is admitted
+def admit_request(route, ip_address, key):
+    if not rate_limiting:
+        return 0
     try:
-        with open(filename, 'r', newline='') as file:
-            reader = csv.DictReader(file)
-            for row in reader:
-                queries.append(row['Query'].lower())
+        wait = rate_limiter.admit(route, ip_address, key if rate_limit_keys and key == server_key else None)
     except Exception as e:
-        logging.error(f"Error loading data: {e}")
-    return queries
+        logging.error(f"Error checking rate limits: {e}")
+        return 0
+    if wait:
+        increment_counter('rate_limited')
+    return wait
 
-# Function to check if a query is inappropriate using better_profanity
-def is_inappropriate(query):
-    return profanity.contains_profanity(query)
+@app.before_request
+def limit_request_rate():
+    if request.url_rule is None:
+        return None
+    wait = admit_request(request.url_rule.rule, forwarded_client(request.remote_addr, request.headers.get('X-Forwarded-For')),
+                         request.args.get('key'))
+    if wait:
+        response = jsonify({'error': 'Too many requests'})
+        response.status_code = 429
+        response.headers['Retry-After'] = str(math.ceil(wait))
+        return response
+    return None
 
 # API endpoint to search wallpapers
 @app.route('/search_wallpapers', methods=['GET'])
@@ -140,7 +2320,7 @@ def search_wallpapers_route():
     if not validate_key(request):
         return jsonify({'error': 'Invalid client key'}), 401
 
-    query = request.args.get('query')
+    query = normalize_query(request.args.get('query') or '')
     if not query:
         return jsonify({'error': 'Query parameter is required'}), 400
 
@@ -148,34 +2328,178 @@ def search_wallpapers_route():
     if is_inappropriate(query):
         return jsonify([{'Image': 'https://i.pinimg.com/736x/95/55/07-9555074fb5a23ba2f2513597a95827a1.jpg'}]), 400
 
-    client_ip = request.remote_addr
+    try:
+        pagination = parse_search_pagination(request.args)
+        proxy_width = parse_image_proxy(request.args)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+
+    client_ip = forwarded_client(request.remote_addr, request.headers.get('X-Forwarded-For')) or request.remote_addr
+    if pagination is not None:
+        images, next_cursor = search_wallpapers_page(query, *pagination)
+        # Only a search from the start counts as a query, not fetching its later pages
+        from_start = pagination[:3] == (1, 0, 0)
+        if from_start:
+            log_query(client_ip, query, bool(images))
+        if not images and from_start:
+            return jsonify([{'recommend': 'No wallpapers found for the given query'}]), 404
+        if proxy_width is not None:
+            images = [proxied_image_url(request.host_url, url, proxy_width) for url in images]
+        body, etag = encode_search_page(images, next_cursor)
+        return json_bytes_response(body, etag, cache_ttl)
+
+    # The pre-encoded body holds the upstream URLs, proxied ones are encoded per request
+    cached = cached_search_response(query) if proxy_width is None else None
+    if cached is not None:
+        log_query(client_ip, query, True)
+        body, etag, age = cached
+        return json_bytes_response(body, etag, cache_ttl - age)
+
     image_urls, success = search_wallpapers(query)
-    with open('ip_query_log.csv', 'a', newline='') as file:
-        log_query(client_ip, query, success, file)
+    log_query(client_ip, query, success)
 
     if success:
-        response_data = [{'Image': url} for url in image_urls]
-        return jsonify(response_data), 200
+        if proxy_width is not None:
+            image_urls = [proxied_image_url(request.host_url, url, proxy_width) for url in image_urls]
+        body, etag = encode_search_response(image_urls)
+        return json_bytes_response(body, etag, cache_ttl)
     else:
         return jsonify([{'recommend': 'No wallpapers found for the given query'}]), 404
 
+# API endpoint to search many queries at once, as {"queries": [...]} or repeated query parameters
+@app.route('/search_batch', methods=['GET', 'POST'])
+def search_batch_route():
+    if not validate_key(request):
+        return jsonify({'error': 'Invalid client key'}), 401
+
+    if request.method == 'POST':
+        payload = request.get_json(silent=True)
+        raw_queries = payload.get('queries') if isinstance(payload, dict) else None
+    else:
+        raw_queries = request.args.getlist('query')
+    if not isinstance(raw_queries, list) or not raw_queries or not all(isinstance(query, str) for query in raw_queries):
+        return jsonify({'error': 'A non-empty list of queries is required'}), 400
+    if len(raw_queries) > search_batch_max_queries:
+        return jsonify({'error': f"At most {search_batch_max_queries} queries per batch"}), 400
+
+    try:
+        proxy_width = parse_image_proxy(request.args)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+
+    canonical = [normalize_query(query) for query in raw_queries]
+    distinct = list(dict.fromkeys(query for query in canonical if query))
+    inappropriate = dict(zip(distinct, profanity_filter.check_batch(distinct)))
+    found, errors = search_batch([query for query in distinct if not inappropriate[query]])
+
+    client_ip = forwarded_client(request.remote_addr, request.headers.get('X-Forwarded-For')) or request.remote_addr
+    for query in distinct:
+        if not inappropriate[query]:
+            log_query(client_ip, query, found.get(query, ([], False))[1])
+
+    results = []
+    for raw_query, query in zip(raw_queries, canonical):
+        if not query:
+            results.append({'query': raw_query, 'status': 'invalid', 'error': 'Query parameter is required'})
+        elif inappropriate[query]:
+            results.append({'query': raw_query, 'status': 'inappropriate', 'error': 'Inappropriate query'})
+        elif query in errors:
+            results.append({'query': raw_query, 'status': errors[query], 'error': 'Search failed, try again later'})
+        elif not found[query][1]:
+            results.append({'query': raw_query, 'status': 'not_found', 'error': 'No wallpapers found for the given query'})
+        else:
+            image_urls = found[query][0]
+            if proxy_width is not None:
+                image_urls = [proxied_image_url(request.host_url, url, proxy_width) for url in image_urls]
+            results.append({'query': raw_query, 'status': 'ok', 'images': [{'Image': url} for url in image_urls]})
+
+    return jsonify({'results': results}), 200
+
+# API endpoint serving wallpapers through the image cache; width picks a thumbnail
+@app.route('/image', methods=['GET'])
+def proxy_image():
+    source = request.args.get('url') or ''
+    if not source or not hmac.compare_digest(request.args.get('sig') or '', sign_image_url(source)):
+        return jsonify({'error': 'Invalid image signature'}), 403
+
+    try:
+        width = parse_image_width(request.args.get('width'))
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+
+    try:
+        digest, content_type = get_image(source, width)
+    except Exception as e:
+        logging.error(f"Error fetching image {source}: {e}")
+        return jsonify({'error': 'Image not available'}), 502
+
+    # Files never change, so clients can keep them; send_file handles Range and If-None-Match
+    response = send_file(os.path.abspath(image_path(digest)), mimetype=content_type, conditional=True,
+                         etag=digest, max_age=image_max_age)
+    response.cache_control.public = True
+    response.cache_control.immutable = True
+    return response
+
 # API endpoint to view logs
 @app.route('/view_logs', methods=['GET'])
 def view_logs():
     if not validate_key(request):
         return jsonify({'error': 'Invalid client key'}), 401
 
-    logs = []
     try:
-        with open('ip_query_log.csv', 'r', newline='') as file:
-            reader = csv.DictReader(file)
-            for row in reader:
-                logs.append({'ID': row['ID'], 'IP Address': row['IP Address'], 'Query': row['Query'], 'Timestamp': row['Timestamp'], 'Response Success': row['Response Status']})
-    except Exception as e:
-        logging.error(f"An unexpected error occurred while reading logs: {e}")
-        return jsonify({'error': 'An unexpected error occurred'}), 500
+        filters = parse_log_filters(request.args)
+        cursor = parse_log_cursor(request.args.get('cursor'))
+        limit = request.args.get('limit')
+        if limit is not None:
+            if not limit.isdigit() or int(limit) == 0:
+                raise ValueError("Invalid limit, expected a positive integer")
+            limit = int(limit)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+
+    # Without limit or cursor the whole log is streamed as a plain JSON array;
+    # pages are wrapped in an object (or end with a line, for NDJSON) holding next_cursor
+    ndjson = request.args.get('format') == 'ndjson'
+    paginated = limit is not None or cursor is not None
+    rows = iter_log_rows(filters, cursor)
+    start_cursor = request.args.get('cursor')
+
+    def generate():
+        count = 0
+        last_cursor, next_cursor = start_cursor, None
+        try:
+            if not ndjson:
+                yield '{"logs":[' if paginated else '['
+            for row_cursor, row in rows:
+                if count == limit:
+                    next_cursor = last_cursor
+                    break
+                if ndjson:
+                    yield encode_json(row) + '\n'
+                else:
+                    yield (',' if count else '') + encode_json(row)
+                count += 1
+                last_cursor = row_cursor
+            if ndjson:
+                if paginated:
+                    yield encode_json({'next_cursor': next_cursor}) + '\n'
+            else:
+                yield f'],"next_cursor":{encode_json(next_cursor)}}}\n' if paginated else ']\n'
+        except Exception as e:
+            logging.error(f"An unexpected error occurred while reading logs: {e}")
+            # Never end a failed stream like a complete one: pages end with an error
+            # and the cursor to resume from, a plain array is cut off
+            if not paginated:
+                raise
+            error = {'error': 'Error reading logs, resume from next_cursor', 'next_cursor': last_cursor}
+            if ndjson:
+                yield encode_json(error) + '\n'
+            else:
+                yield f'],"next_cursor":{encode_json(last_cursor)},"error":{encode_json(error["error"])}}}\n'
+        finally:
+            rows.close()
 
-    return jsonify(logs), 200
+    return Response(stream_with_context(generate()), mimetype='application/x-ndjson' if ndjson else 'application/json')
 
 # API endpoint to get recommendations for partial queries
 @app.route('/recommendations', methods=['GET'])
@@ -191,102 +2515,336 @@ def get_recommendations():
     if is_inappropriate(partial_query):
         return jsonify([{'recommend': 'Inappropriate query'}]), 400
 
-    queries = load_data('ip_query_log.csv')
-    query_counter = Counter(queries)
-    vectorizer, model = train_model(queries)
-    recommendations = partial_query_recommendation(partial_query, queries, query_counter, vectorizer, model)
-    recommendations_list = [{'recommend': recommendation} for recommendation in recommendations if not is_inappropriate(recommendation)]
+    recommendations = partial_query_recommendation(partial_query)
+    recommendations_list = [{'recommend': recommendation} for recommendation in appropriate_only(recommendations)]
 
     return jsonify(recommendations_list), 200
 
-# API endpoint to get trending queries
+# Encoded /trending bodies per window, reused for a few seconds
+trending_response_ttl = 5
+trending_responses = TTLCache(maxsize=16, ttl=trending_response_ttl)
+trending_responses_lock = threading.Lock()
+
+# Encoded body and ETag of the trending list for a window
+def trending_response(window):
+    with trending_responses_lock:
+        cached = trending_responses.get(window)
+    if cached is None:
+        trending = trending_queries(window)
+        allowed = set(appropriate_only([query for query, _ in trending]))
+        body = (encode_json([{'query': query, 'count': count} for query, count in trending if query in allowed]) + '\n').encode('utf-8')
+        cached = body, hashlib.blake2b(body, digest_size=16).hexdigest()
+        with trending_responses_lock:
+            trending_responses[window] = cached
+    return cached
+
+# API endpoint to get trending queries, all-time or over a decayed window
 @app.route('/trending', methods=['GET'])
 def get_trending():
     if not validate_key(request):
         return jsonify({'error': 'Invalid client key'}), 401
 
-    queries = load_data('ip_query_log.csv')
-    trending_queries = Counter(queries).most_common(10)
-    trending_list = [{'query': query, 'count': count} for query, count in trending_queries if not is_inappropriate(query)]
+    try:
+        body, etag = trending_response(request.args.get('window', 'all'))
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
 
-    return jsonify(trending_list), 200
+    return json_bytes_response(body, etag, trending_response_ttl)
 
-# Monitoring endpoint
-last_failure_time = None
-last_failure_reason = None
+# API endpoint to read the hourly or daily query rollups
+@app.route('/query_rollups', methods=['GET'])
+def get_query_rollups():
+    if not validate_key(request):
+        return jsonify({'error': 'Invalid client key'}), 401
 
-@app.route('/monitoring', methods=['GET'])
-def monitoring():
-    global last_failure_time, last_failure_reason
     try:
-        # Check if the playit subprocess is running
-        playit_running = is_process_running("playit")
-
-        # Get server CPU and memory usage
-        cpu_percent = psutil.cpu_percent()
-        memory_percent = psutil.virtual_memory().percent
+        period, start_day, end_day, query, limit = parse_rollup_filters(request.args)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
 
-        # Reset last failure reason
-        last_failure_reason = None
-
-        # Return the monitoring information as JSON
-        return jsonify({
-            'playit_status': 'running' if playit_running else 'not running',
-            'cpu_percent': cpu_percent,
-            'memory_percent': memory_percent,
-            'last_failure_time': str(last_failure_time) if last_failure_time else None,
-            'last_failure_reason': last_failure_reason
-        }), 200
+    try:
+        rollups = query_rollups(period, start_day, end_day, query, limit)
+        return jsonify({'rollups': rollups, 'rolled_up_to': rollup_checkpoint()})
     except Exception as e:
-        last_failure_time = time.strftime('%Y-%m-%d %H:%M:%S')
-        last_failure_reason = str(e)
-        logging.error(f"Error in monitoring: {e}")
-        traceback.print_exc()  # Print exception traceback
-        return jsonify({'error': 'An unexpected error occurred'}), 500
+        logging.error(f"Error reading query rollups: {e}")
+        return jsonify({'error': 'Could not read query rollups'}), 500
+
+# Health: the launcher supervises playit and samples host and playit usage
+# every health_sample_interval seconds into the health table, so /monitoring
+# in any worker reads one row instead of scanning the process table.
+health_sample_interval = 5
+health_failure_history = 10
+playit_state = {'pid': None, 'restarts': 0, 'failures': []}
+playit_state_lock = threading.Lock()
 
-def is_process_running(process_name):
-    """
-    Check if there is any running process that contains the given name process_name.
-    """
-    for proc in psutil.process_iter(['pid', 'name']):
-        if process_name.lower() in proc.info['name'].lower():
-            return True
-    return False
+def record_playit_failure(reason):
+    with playit_state_lock:
+        playit_state['failures'].append({'time': time.strftime('%Y-%m-%d %H:%M:%S'), 'reason': reason})
+        del playit_state['failures'][:-health_failure_history]
 
 def monitor_playit():
-    global last_failure_time, last_failure_reason
     while True:
         playit_proc = None
         try:
             playit_proc = subprocess.Popen(["playit"], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
-            while playit_proc.poll() is None:
-                time.sleep(5)
+            with playit_state_lock:
+                playit_state['pid'] = playit_proc.pid
+            record_playit_failure(f"playit exited with code {playit_proc.wait()}")
         except Exception as e:
-            last_failure_time = time.strftime('%Y-%m-%d %H:%M:%S')
-            last_failure_reason = str(e)
+            record_playit_failure(str(e))
             logging.error(f"Error running Playit: {e}")
         finally:
+            with playit_state_lock:
+                playit_state['pid'] = None
             if playit_proc:
                 playit_proc.kill()
+        with playit_state_lock:
+            playit_state['restarts'] += 1
         logging.info("Restarting Playit...")
         time.sleep(5)
 
+# Host usage and the supervised playit process's status, CPU, memory and uptime
+def sample_health(state, process):
+    snapshot = {
+        'cpu_percent': psutil.cpu_percent(),
+        'memory_percent': psutil.virtual_memory().percent,
+        'playit_status': 'not running',
+        'playit_pid': state['pid'],
+        'playit_uptime': None,
+        'playit_cpu_percent': None,
+        'playit_memory_mb': None,
+        'playit_restarts': state['restarts'],
+        'failures': state['failures'],
+    }
+    if process is not None:
+        try:
+            with process.oneshot():
+                if process.status() != psutil.STATUS_ZOMBIE:
+                    snapshot.update(playit_status='running',
+                                    playit_uptime=round(time.time() - process.create_time(), 1),
+                                    playit_cpu_percent=process.cpu_percent(),
+                                    playit_memory_mb=round(process.memory_info().rss / 2 ** 20, 1))
+        except psutil.Error:
+            pass
+    return snapshot
+
+def publish_health(snapshot):
+    get_db().execute('INSERT OR REPLACE INTO health (id, snapshot, updated_at) VALUES (1, ?, ?)',
+                     (json.dumps(snapshot), time.time()))
+
+def run_health_sampler():
+    # CPU percentages are measured since the previous call, so take a first reading
+    psutil.cpu_percent()
+    process = None
+    while True:
+        try:
+            with playit_state_lock:
+                state = dict(playit_state, failures=list(playit_state['failures']))
+            if state['pid'] is None:
+                process = None
+            elif process is None or process.pid != state['pid']:
+                try:
+                    process = psutil.Process(state['pid'])
+                    process.cpu_percent()
+                except psutil.Error:
+                    process = None
+            publish_health(sample_health(state, process))
+        except Exception as e:
+            logging.error(f"Error sampling health: {e}")
+        time.sleep(health_sample_interval)
+
+# Monitoring endpoint
+@app.route('/monitoring', methods=['GET'])
+def monitoring():
+    try:
+        row = get_db().execute('SELECT snapshot, updated_at FROM health WHERE id = 1').fetchone()
+        health = json.loads(row[0]) if row else {}
+        failures = health.get('failures', [])
+        search_counters = read_counters('search_')
+
+        # Return the monitoring information as JSON
+        return jsonify({
+            'playit_status': health.get('playit_status', 'unknown'),
+            'playit_pid': health.get('playit_pid'),
+            'playit_uptime': health.get('playit_uptime'),
+            'playit_cpu_percent': health.get('playit_cpu_percent'),
+            'playit_memory_mb': health.get('playit_memory_mb'),
+            'playit_restarts': health.get('playit_restarts', 0),
+            'cpu_percent': health.get('cpu_percent'),
+            'memory_percent': health.get('memory_percent'),
+            'last_failure_time': failures[-1]['time'] if failures else None,
+            'last_failure_reason': failures[-1]['reason'] if failures else None,
+            'recent_failures': failures,
+            'sample_age': round(time.time() - row[1], 1) if row else None,
+            'search_upstream_calls': search_counters.get('search_upstream_calls', 0),
+            'search_coalesced_local': search_counters.get('search_coalesced_local', 0),
+            'search_coalesced_remote': search_counters.get('search_coalesced_remote', 0)
+        }), 200
+    except Exception as e:
+        logging.error(f"Error in monitoring: {e}")
+        traceback.print_exc()  # Print exception traceback
+        return jsonify({'error': 'An unexpected error occurred'}), 500
+
+# Prometheus metrics endpoint, aggregated over all workers
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    if not validate_key(request):
+        return jsonify({'error': 'Invalid client key'}), 401
+
+    try:
+        return Response(render_metrics(), mimetype='text/plain; version=0.0.4')
+    except Exception as e:
+        logging.error(f"Error rendering metrics: {e}")
+        return jsonify({'error': 'An unexpected error occurred'}), 500
+
+# "sync" serves this Flask app, "async" serves async_server.py on aiohttp workers
+serving_mode = os.environ.get('SERVING_MODE', 'sync')
+
+# Cache warm-up: while gunicorn starts, the launcher fetches the queries most
+# searched in the last warmup_days that are not fresh in the shared cache,
+# warmup_concurrency at a time, for at most warmup_timeout seconds (unfinished
+# fetches continue in the background). The refresher then re-fetches entries
+# refresh_ahead seconds before they expire. Its budget per round is the number
+# of queries searched at least refresh_min_hourly times in the last hour,
+# capped at refresh_max_per_round. Both read the query log and its rollups,
+# which hold queries in the normalized form the search cache is keyed by.
+warmup_queries = 50
+warmup_days = 7
+warmup_concurrency = 4
+warmup_timeout = 30
+refresh_interval = 30
+refresh_ahead = 60
+refresh_min_hourly = 2
+refresh_max_per_round = 50
+
+# Age of a cached entry in seconds, or None when it is not cached
+def cache_age(query):
+    row = get_db().execute('SELECT fetched_at FROM search_cache WHERE query = ?', (query,)).fetchone()
+    return time.time() - row[0] if row else None
+
+def needs_refresh(query, margin=0):
+    age = cache_age(query)
+    return age is None or age >= cache_ttl - margin
+
+def warm_up_cache():
+    try:
+        start_day = time.strftime('%Y-%m-%d', time.localtime(time.time() - warmup_days * 86400))
+        aggregates = load_query_aggregates(start_day, canonical=False)
+        popular = sorted(aggregates, key=lambda query: (-aggregates[query][0], query))[:warmup_queries]
+        queries = appropriate_only(popular)
+        queries = [query for query in queries if needs_refresh(query)]
+        if not queries:
+            return
+        started = time.monotonic()
+        executor = ThreadPoolExecutor(max_workers=warmup_concurrency)
+        done, pending = wait([executor.submit(fetch_wallpapers, query) for query in queries], timeout=warmup_timeout)
+        executor.shutdown(wait=False)
+        logging.info(f"Warmed up {len(done)} of {len(queries)} popular queries in {time.monotonic() - started:.1f}s")
+    except Exception as e:
+        logging.error(f"Error warming up the search cache: {e}")
+
+def run_cache_refresher():
+    executor = ThreadPoolExecutor(max_workers=warmup_concurrency)
+    while True:
+        time.sleep(refresh_interval)
+        try:
+            hot = [query for query, count in recent_query_counts(3600).most_common(refresh_max_per_round)
+                   if count >= refresh_min_hourly]
+            due = [query for query in appropriate_only(hot) if needs_refresh(query, refresh_ahead + refresh_interval)]
+            wait([executor.submit(fetch_wallpapers, query) for query in due])
+            if due:
+                logging.info(f"Refreshed {len(due)} of {len(hot)} hot queries")
+        except Exception as e:
+            logging.error(f"Error refreshing the search cache: {e}")
+
+# Startup: with STARTUP_MODE=preload (the default) gunicorn imports the app
+# once in the master, which also loads the models and the suggestion indexes
+# and freezes them out of the garbage collector before forking, so workers
+# share those pages instead of each building a copy. STARTUP_MODE=lazy lets
+# every worker import the app and load state on first use.
+startup_mode = os.environ.get('STARTUP_MODE', 'preload')
+first_request_pid = None
+# When this process started serving: the import, or the fork for a preloaded worker
+worker_started = import_started
+
+# Load what workers only read, before the master forks them
+def preload_shared_state():
+    started = time.monotonic()
+    reload_models()
+    sync_prefix_index(min_interval=0)
+    close_db()
+    gc.freeze()
+    logging.info(f"Preloaded shared state in {time.monotonic() - started:.2f}s")
+
+# Report import time and time to first request once per worker, as metrics and in the log
+def record_first_request():
+    global first_request_pid
+    if first_request_pid == os.getpid():
+        return
+    first_request_pid = os.getpid()
+    seconds = time.monotonic() - worker_started
+    observe('startup_seconds', import_seconds, phase='import')
+    observe('startup_seconds', seconds, phase='first_request')
+    logging.info(f"Worker {os.getpid()} served its first request {seconds:.2f}s after starting")
+
+# A forked worker gets fresh locks and executors: a lock held by one of the
+# parent's threads at fork time would never be released, and the parent's pool
+# threads and in-flight fetches do not exist in the child
+def reinit_after_fork():
+    global worker_started, metrics_lock, log_flusher_lock, refreshing_lock, flights_lock, model_reload_lock
+    global prefix_index_lock, trending_responses_lock, playit_state_lock, refresh_executor, batch_executor
+    worker_started = time.monotonic()
+    metrics_lock = threading.Lock()
+    log_flusher_lock = threading.Lock()
+    refreshing_lock = threading.Lock()
+    flights_lock = threading.Lock()
+    model_reload_lock = threading.Lock()
+    prefix_index_lock = threading.Lock()
+    trending_responses_lock = threading.Lock()
+    playit_state_lock = threading.Lock()
+    profanity_filter.memo_lock = threading.Lock()
+    refreshing.clear()
+    flights.clear()
+    refresh_executor = ThreadPoolExecutor(max_workers=2)
+    batch_executor = ThreadPoolExecutor(max_workers=search_batch_concurrency)
+
+os.register_at_fork(after_in_child=reinit_after_fork)
+
+def gunicorn_command():
+    command = ["gunicorn", "--bind", "0.0.0.0:5000", "--workers", "4"]
+    if startup_mode == 'preload':
+        command.append("--preload")
+    if serving_mode == 'async':
+        return command + ["--worker-class", "aiohttp.GunicornWebWorker", "async_server:app"]
+    return command + ["--threads", "2", "main_server:app"]
+
 def run_flask_app():
-    setup_csv()
+    setup_log_store()
+    setup_query_stats()
 
     try:
-        logging.info("Starting server...")
+        logging.info(f"Starting server in {serving_mode} mode with {startup_mode} startup...")
+        threading.Thread(target=warm_up_cache, daemon=True).start()
         threading.Thread(target=monitor_playit, daemon=True).start()
-        subprocess.run(["gunicorn", "--bind", "0.0.0.0:5000", "--workers", "4", "--threads", "2", "main:app"], check=True)
+        threading.Thread(target=run_health_sampler, daemon=True).start()
+        threading.Thread(target=run_log_compaction, daemon=True).start()
+        threading.Thread(target=run_query_rollups, daemon=True).start()
+        threading.Thread(target=run_cache_refresher, daemon=True).start()
+        env = dict(os.environ, PRELOAD_SHARED_STATE='1' if startup_mode == 'preload' else '0')
+        subprocess.run(gunicorn_command(), check=True, env=env)
     except Exception as e:
         logging.error(f"Error running Flask app: {e}")
         traceback.print_exc()  # Print exception traceback
 
+import_seconds = time.monotonic() - import_started
+logging.info(f"Imported main_server in {import_seconds:.2f}s")
+if os.environ.get('PRELOAD_SHARED_STATE') == '1':
+    preload_shared_state()
+
 def signal_handler(sig, frame):
     logging.info("Exiting...")
     exit(0)
 
 if __name__ == "__main__":
-    profanity.load_censor_words()
     signal.signal(signal.SIGINT, signal_handler)
     run_flask_app()
@@ -0,0 +1,22 @@
+import os
+import sys
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import main_server
+
+def close_connections():
+    main_server.close_db()
+    for conn in getattr(main_server._segment_local, 'conns', {}).values():
+        conn.close()
+    main_server._segment_local.conns = {}
+
+# Each test gets its own working directory, so the state database and log
+# store it creates start empty
+@pytest.fixture
+def state_dir(tmp_path, monkeypatch):
+    close_connections()
+    monkeypatch.chdir(tmp_path)
+    yield tmp_path
+    close_connections()
@@ -0,0 +1,41 @@
+import pytest
+import main_server
+from main_server import append_log_records, compact_log_segments, iter_log_rows, parse_log_cursor, server_key
+
+def log_rows(day, queries):
+    return [['client', '198.51.100.1', query, f'{day} 12:00:{i:02d}', 'True'] for i, query in enumerate(queries)]
+
+@pytest.mark.parametrize('value', ['garbage:5', '2026-13-99:1', '2026-02-30:1', '../2026-01-01:1', '2026-1-1:1',
+                                   '2026-01-01:', '2026-01-01:x', ':5'])
+def test_invalid_cursors_are_rejected(value):
+    with pytest.raises(ValueError):
+        parse_log_cursor(value)
+
+def test_valid_cursors():
+    assert parse_log_cursor('2026-01-31:7') == ('2026-01-31', 7)
+    assert parse_log_cursor('2026-01:12') == ('2026-01', 12)
+    assert parse_log_cursor(None) is None
+
+def test_view_logs_rejects_invalid_cursor(state_dir):
+    response = main_server.app.test_client().get(f'/view_logs?key={server_key}&cursor=garbage:5')
+    assert response.status_code == 400
+
+# A cursor into a day segment resumes at the same row after the day is compacted into its month
+def test_cursor_survives_compaction(state_dir):
+    main_server.setup_log_store()
+    append_log_records(log_rows('2020-01-03', ['q0', 'q1', 'q2']) + log_rows('2020-01-04', ['q3', 'q4', 'q5', 'q6']))
+    rows = iter_log_rows()
+    cursor = [next(rows) for _ in range(5)][-1][0]
+    rows.close()
+    assert cursor == '2020-01-04:2'
+    compact_log_segments()
+    assert main_server.log_segments() == ['2020-01']
+    assert [row['Query'] for _, row in iter_log_rows(after=parse_log_cursor(cursor))] == ['q5', 'q6']
+
+# Without plural folding the query filter matches only what was asked for
+def test_query_filter_matches_substrings_of_the_query(state_dir):
+    main_server.setup_log_store()
+    append_log_records(log_rows('2020-01-03', ['cats', 'black cats', 'cat', 'category', 'concatenate']))
+    assert [row['Query'] for _, row in iter_log_rows({'query': 'Cats'})] == ['cats', 'black cats']
+    assert [row['Query'] for _, row in iter_log_rows({'query': 'cat'})] == ['cats', 'black cats', 'cat', 'category',
+                                                                            'concatenate']
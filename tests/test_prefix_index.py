@@ -0,0 +1,53 @@
+import random
+import sqlite3
+import threading
+import time
+from collections import Counter
+import pytest
+import main_server
+from main_server import PrefixIndex, record_query_stats
+
+def reference_search(counts, prefix, top_n, min_frequency):
+    matches = sorted((-count, query) for query, count in counts.items() if query.startswith(prefix))
+    return [(query, -negative) for negative, query in matches[:top_n] if -negative >= min_frequency]
+
+def random_query(rng):
+    words = ['cat', 'cats', 'car', 'cars', 'city', 'sunset', 'sun', 'sea', 'café', 'naïve', '東京', 'tokyo', 'z']
+    return ' '.join(rng.choice(words) for _ in range(rng.randint(1, 3)))
+
+# Small limits, so searches cross precomputed ranges, deltas, spliced and rebuilt snapshots
+@pytest.mark.parametrize('seed', range(5))
+def test_matches_brute_force(monkeypatch, seed):
+    monkeypatch.setattr(main_server, 'prefix_scan_limit', 8)
+    monkeypatch.setattr(main_server, 'prefix_delta_limit', 40)
+    rng = random.Random(seed)
+    index, counts = PrefixIndex(), {}
+    for batch_size in [500] + [rng.choice([1, 5, 30, 60]) for _ in range(60)]:
+        batch = []
+        for _ in range(batch_size):
+            query = random_query(rng)
+            batch.append((query, counts.get(query, 0) + rng.randint(1, 4)))
+        index.update(batch)
+        for query, count in batch:
+            counts[query] = max(counts.get(query, 0), count)
+        for query in rng.sample(sorted(counts), 10) + ['', 'c', 'ca', 'caf', 'cat c', '東', 'x']:
+            for prefix in {query, query[:1], query[:3], query[:len(query) // 2]}:
+                for min_frequency in (1, 5):
+                    assert index.search(prefix, 5, min_frequency) == reference_search(counts, prefix, 5, min_frequency)
+        assert all(index.count(query) == count for query, count in counts.items())
+
+# A batch that waits for the write lock is stamped after the writer before it
+# commits, so a sync that saw that writer's rows still finds the batch
+def test_stats_are_stamped_after_the_write_lock(state_dir):
+    main_server.get_db()
+    blocker = sqlite3.connect(main_server.state_db, isolation_level=None)
+    blocker.execute('BEGIN IMMEDIATE')
+    writer = threading.Thread(target=record_query_stats, args=(Counter({'waited': 5}),))
+    writer.start()
+    time.sleep(0.5)
+    released_at = time.time()
+    blocker.execute('COMMIT')
+    writer.join()
+    blocker.close()
+    updated_at = main_server.get_db().execute("SELECT updated_at FROM query_stats WHERE query = 'waited'").fetchone()[0]
+    assert updated_at >= released_at
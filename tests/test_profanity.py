@@ -0,0 +1,43 @@
+import pytest
+from better_profanity import Profanity
+from better_profanity.utils import read_wordlist, get_complete_path_of_file
+from main_server import is_inappropriate, profanity_filter
+
+WORDS = list(read_wordlist(get_complete_path_of_file('profanity_wordlist.txt')))
+
+# Ways a listed word turns up in a query
+CONTEXTS = ['{}', '{}!', '!{}', 'what the {}!', '{}?', '({})', '{}.', 'red {} wallpaper', '{}s', 'x{}']
+
+# List entries written with separators that better_profanity cannot match,
+# because it splits words on those characters; the filter catches them
+SEPARATOR_WORDS = {'f-u-c-k', 'f.u.c.k', 'f_u_c_k', 's-h-1-t', 's-h-i-t', 's_h_i_t', 's-o-b', 's.o.b.',
+                   'sh!+', 'sh!t', 'shi+'}
+
+# Every listed word in every context gets better_profanity's verdict, except
+# that the filter also catches the separator entries
+def test_agrees_with_better_profanity():
+    reference = Profanity()
+    reference.load_censor_words()
+    disagreements = []
+    for word in WORDS:
+        for context in CONTEXTS:
+            text = context.format(word)
+            expected = reference.contains_profanity(text)
+            if is_inappropriate(text) != expected and (expected or word not in SEPARATOR_WORDS):
+                disagreements.append((text, expected))
+    assert disagreements == []
+
+@pytest.mark.parametrize('query', ['fuck!', 'what the fuck!', 'bitch!', 'asshole!', 'p0rn!', 'sh!t!', '!fuck',
+                                   'b!tch', 'p@rn', '@$$', 'blow jobs', 'f u c k s'])
+def test_catches(query):
+    assert is_inappropriate(query)
+
+@pytest.mark.parametrize('query', ['sunset!', 'hello!', 'classic cars', 'pass port', 'class assignment', 'cocktail',
+                                   'skills', 'hill', 'me@home', 'blow dry'])
+def test_allows(query):
+    assert not is_inappropriate(query)
+
+# A batch never joins words across its queries
+def test_check_batch_matches_single_checks():
+    queries = ['blow', 'jobs', 'sunset!', 'fuck!', 'a', 'ss', 'what the sh!t']
+    assert profanity_filter.check_batch(queries) == [is_inappropriate(query) for query in queries]
@@ -0,0 +1,28 @@
+from main_server import RateLimiter, forwarded_client, rate_limits
+
+def test_forwarded_client_trusts_only_proxies():
+    assert forwarded_client('203.0.113.7', '198.51.100.1') == '203.0.113.7'
+    assert forwarded_client('127.0.0.1', '198.51.100.1') == '198.51.100.1'
+    assert forwarded_client('127.0.0.1', 'spoofed, 198.51.100.1, 127.0.0.1') == '198.51.100.1'
+    assert forwarded_client('127.0.0.1', None) is None
+    assert forwarded_client('::1', '127.0.0.1') is None
+
+def test_ip_bucket_allows_burst_then_rate(tmp_path):
+    limiter = RateLimiter(str(tmp_path / 'rate_limits.bin'), 1024)
+    rate, burst = rate_limits['/search_wallpapers']['ip']
+    assert all(limiter.admit('/search_wallpapers', '198.51.100.1', now=1000.0) == 0 for _ in range(burst))
+    assert limiter.admit('/search_wallpapers', '198.51.100.1', now=1000.0) == 1 / rate
+    assert limiter.admit('/search_wallpapers', '198.51.100.2', now=1000.0) == 0
+    assert limiter.admit('/search_wallpapers', '198.51.100.1', now=1000.0 + 1 / rate) == 0
+
+# Tunnelled requests that name no client are not limited as one shared client
+def test_unknown_client_has_no_ip_bucket(tmp_path):
+    limiter = RateLimiter(str(tmp_path / 'rate_limits.bin'), 1024)
+    assert all(limiter.admit('/search_batch', None, now=1000.0) == 0 for _ in range(100))
+
+# Clients whose buckets collide in one slot share its budget instead of refilling it
+def test_colliding_buckets_share_a_slot(tmp_path):
+    limiter = RateLimiter(str(tmp_path / 'rate_limits.bin'), 1)
+    rate, burst = rate_limits['/search_wallpapers']['ip']
+    admitted = sum(limiter.admit('/search_wallpapers', f'198.51.100.{i % 20}', now=1000.0) == 0 for i in range(200))
+    assert admitted == burst
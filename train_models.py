@@ -0,0 +1,61 @@
+import argparse
+import json
+import logging
+import os
+import shutil
+import time
+import joblib
+import numpy as np
+from main_server import load_query_counts, train_model, models_dir
+
+# Write one versioned set of recommendation artifacts and point models/CURRENT at it
+def train_and_save(start_day=None, end_day=None, output_dir=models_dir):
+    query_counter = load_query_counts(start_day, end_day)
+    query_counter.pop('', None)
+    if not query_counter:
+        raise ValueError("No queries found in the query log")
+    queries = sorted(query_counter)
+    vectorizer, kmeans = train_model(queries)
+    matrix = vectorizer.transform(queries).tocsr()
+
+    version = time.strftime('v%Y%m%d%H%M%S')
+    tmp_path = os.path.join(output_dir, f'.{version}.tmp')
+    os.makedirs(tmp_path)
+    joblib.dump(vectorizer, os.path.join(tmp_path, 'vectorizer.joblib'))
+    joblib.dump(kmeans, os.path.join(tmp_path, 'kmeans.joblib'))
+    np.save(os.path.join(tmp_path, 'tfidf_data.npy'), matrix.data)
+    np.save(os.path.join(tmp_path, 'tfidf_indices.npy'), matrix.indices)
+    np.save(os.path.join(tmp_path, 'tfidf_indptr.npy'), matrix.indptr)
+    np.save(os.path.join(tmp_path, 'counts.npy'), np.array([query_counter[q] for q in queries], dtype=np.int64))
+    np.save(os.path.join(tmp_path, 'labels.npy'), kmeans.labels_.astype(np.int32))
+    with open(os.path.join(tmp_path, 'queries.json'), 'w') as file:
+        json.dump(queries, file)
+    with open(os.path.join(tmp_path, 'meta.json'), 'w') as file:
+        json.dump({'version': version, 'created_at': time.time(), 'start_day': start_day, 'end_day': end_day,
+                   'n_queries': len(queries), 'shape': list(matrix.shape)}, file)
+    os.rename(tmp_path, os.path.join(output_dir, version))
+
+    # Workers poll CURRENT, so replace it atomically
+    with open(os.path.join(output_dir, 'CURRENT.tmp'), 'w') as file:
+        file.write(version)
+    os.replace(os.path.join(output_dir, 'CURRENT.tmp'), os.path.join(output_dir, 'CURRENT'))
+    return version, len(queries)
+
+# Remove all but the newest versions; mapped files stay readable until workers let go of them
+def prune_versions(output_dir=models_dir, keep=3):
+    versions = sorted(name for name in os.listdir(output_dir) if name.startswith('v'))
+    for version in versions[:-keep]:
+        shutil.rmtree(os.path.join(output_dir, version), ignore_errors=True)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Train the recommendation models from the query log")
+    parser.add_argument('--since', help="first day of the query log to train from (YYYY-MM-DD)")
+    parser.add_argument('--until', help="last day of the query log to train from (YYYY-MM-DD)")
+    parser.add_argument('--output', default=models_dir, help="directory holding the model versions")
+    parser.add_argument('--keep', type=int, default=3, help="number of versions to keep")
+    args = parser.parse_args()
+
+    os.makedirs(args.output, exist_ok=True)
+    version, n_queries = train_and_save(args.since, args.until, args.output)
+    prune_versions(args.output, args.keep)
+    logging.info(f"Trained models {version} on {n_queries} distinct queries")